@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+#
+# Command latency to the measurement daemon against a local fake daemon:
+# a new connection and thread per command (the original send_measure_*)
+# versus the persistent ControlClient, sequential and pipelined. Also
+# checks reply matching, timeouts, a daemon that hangs up after every
+# reply and a daemon that is not running.
+#
+#   python3 bench_control.py
+#   python3 bench_control.py --commands 2000 --delay-ms 1
+#
+
+import socket
+import argparse
+import threading
+import socketserver
+from time import perf_counter, sleep
+
+from control_client import ControlClient
+
+
+class FakeDaemon(socketserver.ThreadingTCPServer):
+    """
+    Answers every "<command>\\n" line with "ok <command> <n>\\n" after
+    delay seconds. Lines starting with "hang" get no answer; with
+    one_shot the connection is closed after the first reply.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, delay=0.0, one_shot=False):
+        self.delay = delay
+        self.one_shot = one_shot
+        self.count = 0
+        self.connections = 0
+        super().__init__(("127.0.0.1", 0), FakeDaemonHandler)
+        self.port = self.server_address[1]
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeDaemonHandler(socketserver.StreamRequestHandler):
+
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        server = self.server
+        server.connections += 1
+        for line in self.rfile:
+            command = line.decode().strip()
+            if command.startswith("hang"):
+                continue
+            if server.delay:
+                sleep(server.delay)
+            server.count += 1
+            self.wfile.write(f"ok {command} {server.count}\n".encode())
+            self.wfile.flush()
+            if server.one_shot:
+                return
+
+
+def legacy_send(command, port):
+    """Original send_measure_start/stop: one connection per command."""
+    with socket.create_connection(('127.0.0.1', port)) as sock:
+        sock.sendall(command.encode() + b'\n')
+        return sock.recv(4096).decode('utf-8')
+
+
+def percentile(sorted_values, p):
+    idx = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+def report(name, samples, total=None):
+    values = sorted(samples)
+    line = (f"  {name:<24} p50 {percentile(values, 50) * 1e6:8.1f}"
+            f"  p99 {percentile(values, 99) * 1e6:8.1f}"
+            f"  max {values[-1] * 1e6:8.1f} us")
+    if total is not None:
+        line += f"  {len(values) / total:8.0f} cmd/s"
+    print(line)
+
+
+class Results:
+    """Collects ControlClient callbacks, wait(n) blocks until n arrived."""
+
+    def __init__(self):
+        self.items = []
+        self.cond = threading.Condition()
+
+    def __call__(self, command, result, response, latency):
+        with self.cond:
+            self.items.append((command, result, response, latency))
+            self.cond.notify_all()
+
+    def wait(self, n, timeout=10.0):
+        with self.cond:
+            assert self.cond.wait_for(lambda: len(self.items) >= n, timeout), \
+                f"only {len(self.items)} of {n} results"
+        return self.items
+
+
+def bench_legacy(port, commands):
+    samples = []
+    done = threading.Event()
+
+    def one(start):
+        legacy_send("measure_start", port)
+        samples.append(perf_counter() - start)
+        done.set()
+
+    begin = perf_counter()
+    for _ in range(commands):
+        done.clear()
+        threading.Thread(target=one, args=(perf_counter(),), daemon=True).start()
+        done.wait()
+    report("new connection + thread", samples, perf_counter() - begin)
+
+
+def bench_persistent(port, commands):
+    client = ControlClient(port=port)
+    results = Results()
+    begin = perf_counter()
+    for i in range(commands):
+        client.send("measure_start", results)
+        results.wait(i + 1)
+    report("persistent, sequential", [r[3] for r in results.items],
+           perf_counter() - begin)
+
+    results = Results()
+    begin = perf_counter()
+    for i in range(commands):
+        client.send(f"measure_stop {i}", results)
+    items = results.wait(commands)
+    report("persistent, pipelined", [r[3] for r in items], perf_counter() - begin)
+    # replies are matched to the right commands
+    for command, result, response, _ in items:
+        assert result == ControlClient.RESULT_REPLY
+        assert response.startswith(f"ok {command} "), (command, response)
+    client.close()
+
+
+def check_failures():
+    # no answer: timeout, and the next command gets a fresh connection
+    daemon = FakeDaemon()
+    client = ControlClient(port=daemon.port, timeout=0.2)
+    results = Results()
+    client.send("hang", results)
+    items = results.wait(1)
+    assert items[0][1] == ControlClient.RESULT_TIMEOUT, items
+    client.send("measure_start", results)
+    items = results.wait(2)
+    assert items[1][1] == ControlClient.RESULT_REPLY, items
+    client.close()
+    daemon.close()
+
+    # daemon closes after every reply: pipelined commands still all answered
+    daemon = FakeDaemon(one_shot=True)
+    client = ControlClient(port=daemon.port)
+    results = Results()
+    for i in range(5):
+        client.send(f"measure_start {i}", results)
+    items = results.wait(5)
+    assert all(r[1] == ControlClient.RESULT_REPLY for r in items), items
+    client.close()
+    daemon.close()
+    print(f"  one-shot daemon: 5 replies over {daemon.connections} connections")
+
+    # nobody listening
+    port = daemon.port
+    client = ControlClient(port=port, timeout=0.2)
+    results = Results()
+    client.send("measure_start", results)
+    items = results.wait(1)
+    assert items[0][1] == ControlClient.RESULT_UNREACHABLE, items
+    client.close()
+    print("  timeout, reconnect and unreachable checks passed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Control connection benchmark")
+    parser.add_argument("--commands", type=int, default=500)
+    parser.add_argument("--delay-ms", type=float, default=0.0,
+                        help="fake daemon processing time per command")
+    args = parser.parse_args()
+
+    daemon = FakeDaemon(args.delay_ms / 1000)
+    try:
+        print(f"{args.commands} commands, daemon delay {args.delay_ms} ms")
+        bench_legacy(daemon.port, args.commands)
+        bench_persistent(daemon.port, args.commands)
+    finally:
+        daemon.close()
+    check_failures()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+#
+# Micro-benchmark: per-device decode_device_data() vs. batched decode_devices()
+#
+# Builds a synthetic shm image in memory, so it runs without the acquisition
+# daemon:
+#   python3 bench_decode.py
+#
+
+import timeit
+
+from shm_read import ShmRead, decode_device_data, decode_devices
+
+REPEAT = 5
+NUMBER = 2000
+
+
+def make_raw(num_devices):
+    raw = bytearray(ShmRead.SHM_SIZE)
+    ShmRead.ShmHeader.pack_into(
+        raw, 0,
+        1, 0, 1, 0, 0, 0,
+        num_devices, 1000, 50, 3900, 5000, 80
+    )
+    for i in range(num_devices):
+        ShmRead.ShmDevice.pack_into(
+            raw, ShmRead.ShmHeader.size + i * ShmRead.ShmDevice.size,
+            1000 + i, True, False,
+            -10, 10, -20, 20, -30, 30,
+            i, 3700 + i, 0, -60 - i
+        )
+    return bytes(raw)
+
+
+def per_device(raw, num_devices):
+    return [decode_device_data(raw, i) for i in range(num_devices)]
+
+
+def batched(raw, num_devices):
+    return decode_devices(raw, num_devices)
+
+
+def best_us(func, raw, num_devices):
+    times = timeit.repeat(lambda: func(raw, num_devices),
+                          repeat=REPEAT, number=NUMBER)
+    return min(times) / NUMBER * 1e6
+
+
+def main():
+    print(f"{'devices':>8} {'per-device [us]':>16} {'batched [us]':>13} {'speedup':>8}")
+    for num_devices in (1, 16, ShmRead.MAX_DEVICES):
+        raw = make_raw(num_devices)
+        t_single = best_us(per_device, raw, num_devices)
+        t_batch = best_us(batched, raw, num_devices)
+        print(f"{num_devices:>8} {t_single:>16.2f} {t_batch:>13.2f} {t_single / t_batch:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
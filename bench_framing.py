@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+#
+# Benchmark of the fragment codec in framing.py: encode_fragments() against
+# the original inline bytearray implementation, and Reassembler throughput.
+# Also checks that both encoders produce identical fragments.
+#
+#   python3 bench_framing.py
+#
+
+import os
+import zlib
+import struct
+import timeit
+
+from framing import encode_fragments, Reassembler
+
+REPEAT = 5
+BLOB_SIZES = (256, 1024, 4096, 16384)
+PACKET_SIZES = (100, 234, 502)
+
+
+def legacy_split(data_blob, dataid, packet_size):
+    """Original DataboxStateCharacteristic.split_into_packets loop."""
+    packets = []
+    section_id = 0
+    paket_id = 1
+    last_section = 0
+    last_paket = 1
+    crc_full = zlib.crc32(data_blob) & 0xFFFFFFFF
+    for i in range(0, len(data_blob), packet_size):
+        chunk = bytearray()
+        chunk += struct.pack('<B', dataid)
+        chunk += struct.pack('<H', section_id)
+        chunk += struct.pack('<B', paket_id)
+        chunk += data_blob[i:i + packet_size]
+        crc = zlib.crc32(chunk) & 0xFFFFFFFF
+        pLen = 2 + len(chunk) + 4
+        packets.append(struct.pack('<H', pLen) + chunk + crc.to_bytes(4, byteorder="little"))
+        last_section = section_id
+        last_paket = paket_id
+        paket_id = paket_id + 1
+        if paket_id > 255:
+            section_id = section_id + 1
+            paket_id = 0
+    chunk = bytearray()
+    chunk += struct.pack('<B', dataid)
+    chunk += struct.pack('<H', 0)
+    chunk += struct.pack('<B', 0)
+    chunk += struct.pack('<H', last_section)
+    chunk += struct.pack('<B', last_paket)
+    chunk += crc_full.to_bytes(4, byteorder="little")
+    crc = zlib.crc32(chunk) & 0xFFFFFFFF
+    pLen = 2 + len(chunk) + 4
+    packets.insert(0, struct.pack('<H', pLen) + chunk + crc.to_bytes(4, byteorder="little"))
+    return packets
+
+
+def reassemble(fragments):
+    reassembler = Reassembler()
+    for fragment in fragments:
+        blob = reassembler.feed(fragment)
+    return blob
+
+
+def mb_per_s(func, nbytes):
+    number = max(1, 2_000_000 // nbytes)
+    best = min(timeit.repeat(func, repeat=REPEAT, number=number)) / number
+    return nbytes / best / 1e6
+
+
+def main():
+    print(f"{'blob [B]':>9} {'payload':>8} {'frags':>6} {'legacy MB/s':>12}"
+          f" {'encode MB/s':>12} {'decode MB/s':>12}")
+    for blob_size in BLOB_SIZES:
+        blob = os.urandom(blob_size)
+        for packet_size in PACKET_SIZES:
+            fragments = encode_fragments(blob, 7, packet_size)
+            assert [bytes(f) for f in fragments] == legacy_split(blob, 7, packet_size)
+            assert reassemble(fragments) == blob
+
+            t_legacy = mb_per_s(lambda: legacy_split(blob, 7, packet_size), blob_size)
+            t_encode = mb_per_s(lambda: encode_fragments(blob, 7, packet_size), blob_size)
+            t_decode = mb_per_s(lambda: reassemble(fragments), blob_size)
+            print(f"{blob_size:>9} {packet_size:>8} {len(fragments):>6}"
+                  f" {t_legacy:>12.1f} {t_encode:>12.1f} {t_decode:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+#
+# Notification path of the state characteristic against a socketpair
+# stand-in for BlueZ: the AcquireNotify socket versus PropertiesChanged
+# per fragment, on a private D-Bus bus and a simulated shm segment. Also
+# checks that a full socket requeues the fragment, that a hung up or
+# failing socket falls back to PropertiesChanged, that a hangup ends the
+# subscriptions and that NotifyAcquired follows the socket.
+#
+#   python3 bench_notify.py
+#   python3 bench_notify.py --devices 35 --fragments 5000
+#
+
+import socket
+import argparse
+from time import perf_counter, monotonic, sleep
+
+import dbus
+import dbus.bus
+import dbus.service
+import dbus.mainloop.glib
+from gi.repository import GLib
+
+from definitions import *
+from framing import Reassembler
+from pacing import Pacer
+from service import Service
+from shm_read import ShmRead
+from shm_sim import ShmSimulator
+from mock_bluez import start_private_bus
+from uuidDataboxStateChar import DataboxStateCharacteristic
+
+DEVICE = '/org/bluez/hci0/dev_00_11_22_33_44_55'
+
+
+def percentile(sorted_values, p):
+    idx = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+def report(name, samples):
+    values = sorted(samples)
+    print(f"  {name:<24} p50 {percentile(values, 50) * 1e6:8.1f}"
+          f"  p99 {percentile(values, 99) * 1e6:8.1f}"
+          f"  max {values[-1] * 1e6:8.1f} us")
+
+
+def run_until(condition, timeout=5.0, drain=None):
+    """Iterate the main loop until condition() holds, calling drain() too."""
+    context = GLib.MainContext.default()
+    end = monotonic() + timeout
+    while not condition():
+        assert monotonic() < end, "timed out"
+        if drain is not None:
+            drain()
+        if not context.iteration(False):
+            sleep(0.001)
+
+
+class Signals:
+    """Records what the characteristic emits instead of PropertiesChanged."""
+
+    def __init__(self, state):
+        self.values = []
+        self.properties = []
+        state.PropertiesChanged = self
+
+    def __call__(self, interface, changed, invalidated):
+        if 'Value' in changed:
+            self.values.append(bytes(changed['Value']))
+        else:
+            self.properties.append(dict(changed))
+
+
+def notify_acquired(state):
+    return bool(state.get_properties()[GATT_CHRC_IFACE]['NotifyAcquired'])
+
+
+def acquire(state, mtu):
+    """Call AcquireNotify like BlueZ, return BlueZ's end of the socket."""
+    fd, acquired_mtu = state.AcquireNotify({'device': dbus.ObjectPath(DEVICE),
+                                            'mtu': dbus.UInt16(mtu)})
+    assert acquired_mtu == mtu, acquired_mtu
+    theirs = socket.socket(fileno=fd.take())
+    theirs.setblocking(False)
+    return theirs
+
+
+def bench(state, fragments):
+    """send_packet latency through the socket and as a D-Bus signal."""
+    theirs = acquire(state, 247)
+    packets = state.get_transfer(None, state.get_packet_size(state.get_session({})))
+    samples = []
+    for i in range(fragments):
+        packet = packets[i % len(packets)]
+        start = perf_counter()
+        assert state.send_packet(packet)
+        samples.append(perf_counter() - start)
+        theirs.recv(4096)
+    report("AcquireNotify socket", samples)
+    state.release_notify_socket()
+    theirs.close()
+
+    samples = []
+    for i in range(fragments):
+        packet = packets[i % len(packets)]
+        start = perf_counter()
+        assert state.send_packet(packet)
+        samples.append(perf_counter() - start)
+    report("PropertiesChanged", samples)
+
+
+def check_acquire(state, signals):
+    assert not notify_acquired(state)
+    theirs = acquire(state, 100)
+    assert notify_acquired(state)
+    assert signals.properties[-1] == {'NotifyAcquired': True}, signals.properties
+    # releasing flips it back
+    state.release_notify_socket()
+    assert not notify_acquired(state)
+    assert signals.properties[-1] == {'NotifyAcquired': False}, signals.properties
+    theirs.close()
+    print("  NotifyAcquired follows the socket")
+
+
+def check_socket_full(state, signals):
+    """A session whose socket fills up still delivers the whole blob."""
+    theirs = acquire(state, 23)
+    # small send buffer, so the socket fills up after a few fragments
+    state.notify_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1)
+    session = state.get_session({'device': dbus.ObjectPath(DEVICE)})
+    packets = state.get_session_transfer(session)
+    blocked = []
+    send = state.send_packet
+
+    def counting_send(packet):
+        sent = send(packet)
+        if not sent:
+            blocked.append(packet)
+        return sent
+
+    state.send_packet = counting_send
+    reassembler = Reassembler()
+    received = []
+
+    def drain():
+        # only read once the socket pushed back at least once
+        if not blocked:
+            return
+        while True:
+            try:
+                fragment = theirs.recv(4096)
+            except BlockingIOError:
+                return
+            blob = reassembler.feed(fragment)
+            if blob is not None:
+                received.append(blob)
+
+    session.queue(packets)
+    run_until(lambda: received and not session.is_sending(), drain=drain)
+    del state.send_packet
+    assert blocked, "socket never filled up"
+    assert received[0] == bytes(state.blob), "blob differs"
+    assert not signals.values, "fell back to PropertiesChanged"
+    print(f"  socket full {len(blocked)} times, all {len(packets)} fragments arrived")
+    state.release_notify_socket()
+    theirs.close()
+
+
+def check_hangup(state, signals):
+    """
+    BlueZ closing its end makes notifications go out as signals and, as
+    it does not call StopNotify then, ends subscriptions and transfers.
+    """
+    theirs = acquire(state, 100)
+    session = state.get_session({'device': dbus.ObjectPath(DEVICE)})
+    state.subscribe(session, 10)
+    assert session.subscription is not None
+    theirs.close()
+    run_until(lambda: state.notify_socket is None)
+    assert not notify_acquired(state)
+    assert session.subscription is None and not session.is_sending()
+    before = len(signals.values)
+    assert state.send_packet(b"fragment")
+    assert signals.values[before:] == [b"fragment"], signals.values
+    print("  hangup ends subscriptions, falls back to PropertiesChanged")
+
+
+def check_send_error(state, signals):
+    """A send failing before the hangup is seen falls back right away."""
+    theirs = acquire(state, 100)
+    theirs.close()
+    # no main loop iteration, the HUP watch has not run yet
+    assert state.notify_socket is not None
+    before = len(signals.values)
+    assert state.send_packet(b"fragment")
+    assert state.notify_socket is None
+    assert not notify_acquired(state)
+    assert signals.values[before:] == [b"fragment"], signals.values
+    print("  send error falls back to PropertiesChanged")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Notify socket benchmark")
+    parser.add_argument("--devices", type=int, default=16)
+    parser.add_argument("--fragments", type=int, default=2000)
+    args = parser.parse_args()
+
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    proc, address = start_private_bus()
+    sim = ShmSimulator(num_devices=args.devices)
+    try:
+        bus = dbus.bus.BusConnection(address)
+        service = Service(bus, 0, 'e68de724-46d7-49eb-8635-0f6762da8957', True)
+        shm = ShmRead(sim.path, serial=1234)
+        state = DataboxStateCharacteristic(
+            bus, "state", 'f6dd9ec5-281f-4ad3-a1b3-c2957ad11738', service, shm)
+        # fast pacing, the checks wait for whole transfers
+        state.set_pacer(Pacer(5, 4))
+        shm.update_data()
+        state.update_state(*shm.get_encoded())
+
+        print(f"{args.devices} devices, {args.fragments} fragments")
+        bench(state, args.fragments)
+
+        signals = Signals(state)
+        check_acquire(state, signals)
+        check_socket_full(state, signals)
+        check_hangup(state, signals)
+        check_send_error(state, signals)
+        state.poller.stop()
+        print("  notify socket checks passed")
+    finally:
+        sim.close(unlink=True)
+        proc.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+#
+# Headless benchmark of the state pipeline on a simulated shm segment:
+#   update_data -> encode_ble -> encode_fragments -> fragment stream
+#
+# Runs on a laptop without Bluetooth hardware or the acquisition daemon.
+# The fragment stream pushes every fragment through a SOCK_SEQPACKET
+# socketpair (like the AcquireNotify socket) into a Reassembler.
+#
+#   python3 bench_pipeline.py
+#   python3 bench_pipeline.py --devices 1 16 35 --iterations 2000 --packet-size 234
+#
+
+import socket
+import argparse
+import tracemalloc
+from time import perf_counter
+
+from framing import encode_fragments, Reassembler
+from shm_read import ShmRead
+from shm_sim import ShmSimulator
+
+
+def percentile(sorted_values, p):
+    idx = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+class Stage:
+    """Latency samples and peak allocation of one pipeline stage."""
+
+    def __init__(self, name):
+        self.name = name
+        self.samples = []
+        # None until measured with tracemalloc running
+        self.peak_alloc = None
+
+    def measure(self, func, *args):
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+        start = perf_counter()
+        result = func(*args)
+        self.samples.append(perf_counter() - start)
+        if tracing:
+            _, peak = tracemalloc.get_traced_memory()
+            self.peak_alloc = max(self.peak_alloc or 0, peak - before)
+        return result
+
+    def report(self):
+        values = sorted(self.samples)
+        us = [percentile(values, p) * 1e6 for p in (50, 90, 99)] + [values[-1] * 1e6]
+        line = (f"  {self.name:<20} p50 {us[0]:>9.1f}  p90 {us[1]:>9.1f}"
+                f"  p99 {us[2]:>9.1f}  max {us[3]:>9.1f} us")
+        if self.peak_alloc is not None:
+            line += f"  peak alloc {self.peak_alloc / 1024:>7.1f} KiB"
+        return line
+
+
+def stream(fragments, tx, rx, reassembler):
+    """Push all fragments through the socketpair and reassemble them."""
+    blob = None
+    for fragment in fragments:
+        tx.send(fragment)
+        blob = reassembler.feed(rx.recv(4096))
+    return blob
+
+
+def run(num_devices, iterations, packet_size, trace):
+    sim = ShmSimulator(num_devices=num_devices)
+    shm = ShmRead(sim.path, serial=1234)
+    tx, rx = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    reassembler = Reassembler()
+
+    stages = [Stage("update_data"), Stage("encode_ble"),
+              Stage("encode_fragments"), Stage("fragment stream"),
+              Stage("end to end")]
+    update, encode, split, send, total = stages
+
+    if trace:
+        tracemalloc.start()
+    try:
+        for i in range(iterations):
+            sim.step()
+            sim.write_frame()
+            start = perf_counter()
+            update.measure(shm.update_data)
+            blob = encode.measure(shm.encode_ble)
+            fragments = split.measure(encode_fragments, blob, i % 251, packet_size)
+            received = send.measure(stream, fragments, tx, rx, reassembler)
+            total.samples.append(perf_counter() - start)
+            assert received == blob
+    finally:
+        if trace:
+            tracemalloc.stop()
+        tx.close()
+        rx.close()
+        shm.close()
+        sim.close(unlink=True)
+
+    print(f"{num_devices} devices, {len(blob)} byte blob, "
+          f"{len(fragments)} fragments of <= {packet_size} bytes payload")
+    for stage in stages:
+        print(stage.report())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless state pipeline benchmark")
+    parser.add_argument("--devices", type=int, nargs="+",
+                        default=[1, 16, ShmRead.MAX_DEVICES])
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--packet-size", type=int, default=100)
+    parser.add_argument("--no-trace", action="store_true",
+                        help="skip tracemalloc, it slows every stage down")
+    args = parser.parse_args()
+
+    for num_devices in args.devices:
+        run(num_devices, args.iterations, args.packet_size, not args.no_trace)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+#
+# Benchmark: size and encode time of the msgpack state blob (encode_ble)
+# vs. the columnar wire format (encode_columnar) for 1-35 sensors.
+#
+#   python3 bench_schema.py
+#
+
+import timeit
+
+from bench_decode import make_raw
+from shm_read import ShmRead, decode_header, decode_devices, encode_columnar
+
+REPEAT = 5
+NUMBER = 1000
+SENSOR_COUNTS = (1, 5, 10, 15, 20, 25, 30, ShmRead.MAX_DEVICES)
+
+
+def make_shm(num_devices):
+    """ShmRead holding a decoded synthetic snapshot, without a mapping."""
+    raw = make_raw(num_devices)
+    shm = ShmRead.__new__(ShmRead)
+    shm.serial = 1234
+    shm.databox = decode_header(raw)
+    shm.databox['online'] = True
+    shm.devices = decode_devices(raw, num_devices)
+    return shm
+
+
+def best_us(func):
+    times = timeit.repeat(func, repeat=REPEAT, number=NUMBER)
+    return min(times) / NUMBER * 1e6
+
+
+def main():
+    print(f"{'sensors':>8} {'msgpack [B]':>12} {'columnar [B]':>13}"
+          f" {'msgpack [us]':>13} {'columnar [us]':>14}")
+    for num_devices in SENSOR_COUNTS:
+        shm = make_shm(num_devices)
+        msgpack_blob = shm.encode_ble()
+        columnar_blob = encode_columnar(shm.databox, shm.devices, shm.serial)
+        t_msgpack = best_us(shm.encode_ble)
+        t_columnar = best_us(
+            lambda: encode_columnar(shm.databox, shm.devices, shm.serial))
+        print(f"{num_devices:>8} {len(msgpack_blob):>12} {len(columnar_blob):>13}"
+              f" {t_msgpack:>13.2f} {t_columnar:>14.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -4,12 +4,15 @@ import dbus.service
 from gi.repository import GLib
 from definitions import *
 from exceptions import *
+from property_cache import PropertyCache
 
-class Characteristic(dbus.service.Object):
+class Characteristic(PropertyCache, dbus.service.Object):
     """
     org.bluez.GattCharacteristic1 implementation
     """
 
+    PROPERTIES_IFACE = GATT_CHRC_IFACE
+
     def __init__(self, bus, path, uuid, flags, service):
         self.path = service.get_path() + f'/{path}'
         self.bus = bus
@@ -19,7 +22,7 @@ class Characteristic(dbus.service.Object):
         self.descriptors = []
         dbus.service.Object.__init__(self, bus, self.path)
 
-    def get_properties(self):
+    def build_properties(self):
         return {
             GATT_CHRC_IFACE: {
                 'Service': self.service.get_path(),
@@ -37,6 +40,7 @@ class Characteristic(dbus.service.Object):
 
     def add_descriptor(self, descriptor):
         self.descriptors.append(descriptor)
+        self.invalidate_properties()
 
     def get_descriptors(self):
         return self.descriptors
@@ -167,12 +171,15 @@ class NotifyCharacteristic(Characteristic):
         # print("Default WriteValue called")
         raise NotSupportedException()
 
-class Advertisement(dbus.service.Object):
+class Advertisement(PropertyCache, dbus.service.Object):
     """
     org.bluez.LEAdvertisement1 implementation
     """
 
     PATH_BASE = '/databox/advertisement'
+    PROPERTIES_IFACE = LE_ADVERTISEMENT_IFACE
+    # subclasses assign these directly, e.g. local_name
+    PROPERTY_FIELDS = frozenset(('ad_type', 'local_name', 'include_tx_power'))
 
     def __init__(self, bus, index, advertising_type='peripheral'):
         self.path = self.PATH_BASE + str(index)
@@ -186,7 +193,7 @@ class Advertisement(dbus.service.Object):
         self.include_tx_power = False
         dbus.service.Object.__init__(self, bus, self.path)
 
-    def get_properties(self):
+    def build_properties(self):
         properties = dict()
         properties[LE_ADVERTISEMENT_IFACE] = {
             'Type': self.ad_type,
@@ -204,20 +211,29 @@ class Advertisement(dbus.service.Object):
 
         return properties
 
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name in self.PROPERTY_FIELDS:
+            self.invalidate_properties()
+
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
     def add_service_uuid(self, uuid):
         self.service_uuids.append(uuid)
+        self.invalidate_properties()
 
     def add_solicit_uuid(self, uuid):
         self.solicit_uuids.append(uuid)
+        self.invalidate_properties()
 
     def add_manufacturer_data(self, manuf_code, data):
         self.manufacturer_data[manuf_code] = dbus.Array(data, signature='y')
+        self.invalidate_properties()
 
     def add_service_data(self, uuid, data):
         self.service_data[uuid] = dbus.Array(data, signature='y')
+        self.invalidate_properties()
 
     @dbus.service.method(DBUS_PROP_IFACE,
                          in_signature='ss',
@@ -239,6 +255,11 @@ class Advertisement(dbus.service.Object):
             raise InvalidArgsException()
         return self.get_properties()[LE_ADVERTISEMENT_IFACE]
 
+    @dbus.service.signal(DBUS_PROP_IFACE,
+                         signature='sa{sv}as')
+    def PropertiesChanged(self, interface, changed, invalidated):
+        pass
+
     @dbus.service.method(LE_ADVERTISEMENT_IFACE)
     def Release(self):
         print(f"{self.path}: Released")
\ No newline at end of file
@@ -0,0 +1,44 @@
+import zlib
+
+
+# Version 1 of the preset dictionary. Clients that announce CAP_ZLIB must
+# inflate with exactly these bytes; any change needs a new capability bit.
+ZDICT_VERSION = 1
+
+
+def _fixstr(s):
+    # msgpack fixstr encoding of a short key, as produced by encode_ble()
+    return bytes([0xa0 | len(s)]) + s.encode()
+
+
+def _build_zdict():
+    top_level = [
+        "serial", "measure_start", "num_devices", "diskspace_percent",
+        "usb_connected", "bat_mv", "online", "sensors",
+        "delta", "removed",
+    ]
+    # sensor keys are repeated for every sensor, keep them at the end of
+    # the dictionary where zlib reaches them with the shortest distances
+    sensor = [
+        "serial", "online", "measurement", "bat_mV",
+        "usb_connected", "rssi", "missing_pkgs",
+    ]
+    zdict = b"".join(_fixstr(key) for key in top_level)
+    # map header + keys of one sensor, false/true values in between
+    zdict += b"\x87" + b"".join(_fixstr(key) + b"\xc2\xc3" for key in sensor)
+    zdict += b"\x87" + b"".join(_fixstr(key) for key in sensor)
+    return zdict
+
+
+ZDICT = _build_zdict()
+
+
+def compress(blob, level=9):
+    """zlib-compress blob (zlib format, 15 bit window) with the preset dictionary."""
+    c = zlib.compressobj(level, zlib.DEFLATED, 15, zdict=ZDICT)
+    return c.compress(blob) + c.flush()
+
+
+def decompress(blob):
+    d = zlib.decompressobj(15, zdict=ZDICT)
+    return d.decompress(blob) + d.flush()
@@ -0,0 +1,47 @@
+from definitions import *
+
+
+class ConnectionTracker:
+    """
+    Keeps the set of connected centrals (org.bluez.Device1 object paths).
+
+    Follows the Connected property of BlueZ devices. Characteristics also
+    report devices they hear from via seen(), which covers centrals that
+    connected before the tracker was created.
+    Listeners are called as listener(device_path, connected).
+    """
+
+    def __init__(self, bus):
+        self.connected = set()
+        self._listeners = []
+        bus.add_signal_receiver(
+            self._on_properties_changed,
+            signal_name='PropertiesChanged',
+            dbus_interface=DBUS_PROP_IFACE,
+            bus_name=BLUEZ_SERVICE_NAME,
+            arg0=DEVICE_IFACE,
+            path_keyword='path'
+        )
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def seen(self, device):
+        if device is not None and device not in self.connected:
+            self._set(device, True)
+
+    def _set(self, device, connected):
+        if connected:
+            self.connected.add(device)
+        else:
+            self.connected.discard(device)
+        for listener in self._listeners:
+            listener(device, connected)
+
+    def _on_properties_changed(self, interface, changed, invalidated, path=None):
+        if 'Connected' not in changed:
+            return
+        device = str(path)
+        connected = bool(changed['Connected'])
+        if connected != (device in self.connected):
+            self._set(device, connected)
@@ -0,0 +1,140 @@
+import queue
+import socket
+import threading
+from time import perf_counter
+from collections import deque
+
+import diagnostics
+
+
+class ControlClient:
+    """
+    Long-lived connection to the measurement daemon's line protocol
+    (127.0.0.1:4242, "measure_start\\n" -> one response line).
+
+    One worker thread owns the socket. Commands queued with send() are
+    written back to back and their responses matched in order, so several
+    commands can be in flight; the daemon has to answer every line, in
+    order. The connection is opened on demand and reopened after errors,
+    timeouts, or when the daemon closes it.
+
+    callback(command, result, response, latency) runs on the worker thread
+    with result one of RESULT_*; response is the reply line without the
+    newline (empty unless RESULT_REPLY) and latency the seconds from send()
+    to the result.
+    """
+
+    RESULT_REPLY = 0
+    RESULT_TIMEOUT = 1
+    RESULT_UNREACHABLE = 2
+
+    MAX_LINE = 4096
+
+    def __init__(self, host='127.0.0.1', port=4242, timeout=2.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.sock = None
+        self._buffer = b""
+        self._requests = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def send(self, command, callback=None):
+        self._requests.put((command, callback, perf_counter()))
+
+    def close(self):
+        self._requests.put(None)
+        self._thread.join()
+
+    def _connect(self):
+        self.sock = socket.create_connection((self.host, self.port), self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._buffer = b""
+
+    def _disconnect(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self._buffer = b""
+
+    def _read_line(self, deadline):
+        """Next response line, None if the daemon closed the connection."""
+        while b"\n" not in self._buffer:
+            remaining = deadline - perf_counter()
+            if remaining <= 0:
+                raise socket.timeout()
+            self.sock.settimeout(remaining)
+            chunk = self.sock.recv(self.MAX_LINE)
+            if not chunk:
+                # old daemons answer without a newline and hang up
+                line, self._buffer = self._buffer, b""
+                return line or None
+            self._buffer += chunk
+        line, self._buffer = self._buffer.split(b"\n", 1)
+        return line
+
+    def _take_batch(self):
+        """Block for one request, then take whatever else is already queued."""
+        batch = [self._requests.get()]
+        while batch[-1] is not None:
+            try:
+                batch.append(self._requests.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            stop = batch[-1] is None
+            if stop:
+                batch.pop()
+            if batch:
+                self._exchange(deque(batch))
+            if stop:
+                self._disconnect()
+                return
+
+    def _exchange(self, pending):
+        """Send the pending requests pipelined and deliver their results."""
+        # connection attempts in a row that brought no response
+        failures = 0
+        while pending and failures < 2:
+            failures += 1
+            try:
+                if self.sock is None:
+                    self._connect()
+                self.sock.sendall(b"".join(
+                    command.encode() + b"\n" for command, _, _ in pending))
+                deadline = perf_counter() + self.timeout
+                while pending:
+                    line = self._read_line(deadline)
+                    if line is None:
+                        # closed by the daemon, resend the rest on a new connection
+                        self._disconnect()
+                        break
+                    self._deliver(pending.popleft(), self.RESULT_REPLY,
+                                  line.decode('utf-8', 'replace').strip())
+                    deadline = perf_counter() + self.timeout
+                    failures = 0
+            except socket.timeout:
+                print(f"[Control] no response within {self.timeout}s")
+                self._disconnect()
+                # the commands may have been executed, do not repeat them
+                while pending:
+                    self._deliver(pending.popleft(), self.RESULT_TIMEOUT)
+            except OSError as e:
+                print(f"[Control] connection to {self.host}:{self.port} failed: {e}")
+                self._disconnect()
+        while pending:
+            self._deliver(pending.popleft(), self.RESULT_UNREACHABLE)
+
+    def _deliver(self, request, result, response=""):
+        command, callback, start = request
+        latency = diagnostics.since(f"control_{command}", start) - start
+        if callback is not None:
+            try:
+                callback(command, result, response, latency)
+            except Exception as e:
+                print(f"[Control] callback for {command} failed: {e}")
@@ -8,4 +8,8 @@ GATT_CHRC_IFACE = 'org.bluez.GattCharacteristic1'
 GATT_DESC_IFACE = 'org.bluez.GattDescriptor1'
 
 DBUS_OM_IFACE = 'org.freedesktop.DBus.ObjectManager'
-DBUS_PROP_IFACE = 'org.freedesktop.DBus.Properties'
\ No newline at end of file
+DBUS_PROP_IFACE = 'org.freedesktop.DBus.Properties'
+DEVICE_IFACE = 'org.bluez.Device1'
+
+ONLINE_STATUS_FILE = '/tmp/online.status'
+DATABOX_SN_FILE = '/etc/gallopiq/databox_sn'
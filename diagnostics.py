@@ -0,0 +1,129 @@
+import os
+import json
+import socket
+import threading
+from time import perf_counter
+
+#
+# Always-on timing histograms of the state pipeline.
+#
+# Stages record their duration with record(name, seconds); durations go into
+# power-of-two microsecond buckets, so recording is a few integer operations
+# and memory stays fixed. Counters are updated without a lock; a lost
+# increment between the poller thread and the main loop is acceptable for
+# diagnostics.
+#
+
+# bucket i holds durations of [2**(i-1), 2**i) microseconds, bucket 0 < 1 us
+BUCKETS = 32
+
+STATS_SOCKET = "/tmp/databox_ble_stats.sock"
+
+
+class Histogram:
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.counts[min(int(seconds * 1e6).bit_length(), BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile_us(self, p):
+        """Upper bucket bound in microseconds below which p percent fall."""
+        if not self.count:
+            return 0
+        target = self.count * p / 100
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                return 1 << i
+        return 1 << (BUCKETS - 1)
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean_us": round(self.total / self.count * 1e6, 1) if self.count else 0,
+            "p50_us": self.percentile_us(50),
+            "p99_us": self.percentile_us(99),
+            "max_us": round(self.max * 1e6, 1),
+            "buckets": self.counts,
+        }
+
+
+STATS = {}
+
+
+def histogram(name):
+    hist = STATS.get(name)
+    if hist is None:
+        hist = STATS.setdefault(name, Histogram())
+    return hist
+
+
+def record(name, seconds):
+    histogram(name).record(seconds)
+
+
+def since(name, start):
+    """Record the time since start (a perf_counter value), return now."""
+    now = perf_counter()
+    histogram(name).record(now - start)
+    return now
+
+
+def snapshot():
+    return {name: hist.summary() for name, hist in list(STATS.items())}
+
+
+def compact():
+    """Per stage [count, p50_us, p99_us, max_us], small enough for one GATT read."""
+    return {
+        name: [hist.count, hist.percentile_us(50), hist.percentile_us(99),
+               int(hist.max * 1e6)]
+        for name, hist in list(STATS.items())
+    }
+
+
+class StatsServer:
+    """
+    Unix socket that dumps snapshot() as JSON to every client and closes:
+
+        socat - UNIX-CONNECT:/tmp/databox_ble_stats.sock
+    """
+
+    def __init__(self, path=STATS_SOCKET):
+        self.path = path
+        if os.path.exists(path):
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(4)
+        # served from its own thread, the main loop never waits for a client
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return  # closed
+            with conn:
+                conn.settimeout(1.0)
+                try:
+                    conn.sendall(json.dumps(snapshot(), indent=1).encode() + b"\n")
+                except OSError as e:
+                    print(f"[Stats] dump failed: {e}")
+
+    def close(self):
+        self.sock.close()
+        os.unlink(self.path)
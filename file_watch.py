@@ -0,0 +1,182 @@
+import os
+import time
+import ctypes
+import select
+import struct
+import threading
+
+#
+# Cached values of small status files, refreshed only when the file changes.
+#
+# One watcher thread per process follows the directories of the watched
+# files with inotify (through libc, no extra dependency) and re-reads a file
+# when an event names it. Only events after which the file is complete are
+# watched: a writer closing it, a rename into place or a removal, never
+# IN_MODIFY, which can fire between an O_TRUNC and the write. Every
+# POLL_INTERVAL seconds the stat of every watched file is checked as well,
+# which covers inotify being unavailable, the directory not existing yet
+# and events lost to a queue overflow. Readers only look at the cached
+# value.
+#
+
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+InotifyEvent = struct.Struct("iIII")
+
+POLL_INTERVAL = 2.0
+
+
+class WatchedFile:
+    """
+    Last value of parse(file contents), default while the file is missing
+    or cannot be parsed. Listeners are called with the new value from the
+    watcher thread.
+    """
+
+    def __init__(self, path, parse, default=None):
+        self.path = path
+        self.parse = parse
+        self.default = default
+        self.value = default
+        self._stamp = None
+        self._listeners = []
+        self.refresh()
+
+    def get(self):
+        return self.value
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def refresh(self):
+        """Re-read the file if its stat changed. True if the value changed."""
+        try:
+            st = os.stat(self.path)
+            stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+        except OSError:
+            stamp = None
+        if stamp == self._stamp:
+            return False
+        self._stamp = stamp
+
+        value = self.default
+        if stamp is not None:
+            try:
+                with open(self.path, 'r') as f:
+                    value = self.parse(f.read())
+            except (OSError, ValueError) as e:
+                print(f"[FileWatch] cannot read {self.path}: {e}")
+        if value == self.value:
+            return False
+        self.value = value
+        for listener in list(self._listeners):
+            try:
+                listener(value)
+            except Exception as e:
+                print(f"[FileWatch] listener for {self.path} failed: {e}")
+        return True
+
+
+class FileWatcher:
+
+    def __init__(self):
+        self.files = {}
+        self._lock = threading.Lock()
+        # inotify watch descriptor -> directory
+        self._dirs = {}
+        self._libc = None
+        self.fd = None
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+            if fd >= 0:
+                self._libc = libc
+                self.fd = fd
+        except (OSError, AttributeError) as e:
+            print(f"[FileWatch] no inotify, polling: {e}")
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def watch(self, path, parse, default=None):
+        """Return the WatchedFile of path, shared by all callers."""
+        with self._lock:
+            watched = self.files.get(path)
+            if watched is not None:
+                return watched
+            watched = WatchedFile(path, parse, default)
+            self.files[path] = watched
+            # without a watch the file is only stat'ed every POLL_INTERVAL
+            self._add_watch(os.path.dirname(path))
+            return watched
+
+    def _add_watch(self, directory):
+        if self.fd is None:
+            return False
+        if directory in self._dirs.values():
+            return True
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            return False
+        self._dirs[wd] = directory
+        return True
+
+    def _read_events(self):
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset + InotifyEvent.size <= len(data):
+            wd, mask, cookie, length = InotifyEvent.unpack_from(data, offset)
+            offset += InotifyEvent.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                # events were dropped, any file may have changed
+                print("[FileWatch] inotify queue overflow, checking all files")
+                self._refresh_all()
+                continue
+            directory = self._dirs.get(wd)
+            if directory is None:
+                continue
+            watched = self.files.get(os.path.join(directory, os.fsdecode(name)))
+            if watched is not None:
+                watched.refresh()
+
+    def _refresh_all(self):
+        with self._lock:
+            files = list(self.files.values())
+        for watched in files:
+            watched.refresh()
+
+    def _run(self):
+        next_poll = time.monotonic() + POLL_INTERVAL
+        while True:
+            wait = max(0.0, next_poll - time.monotonic())
+            if self.fd is not None:
+                readable, _, _ = select.select([self.fd], [], [], wait)
+                if readable:
+                    self._read_events()
+            else:
+                time.sleep(wait)
+            if time.monotonic() >= next_poll:
+                # mtime fallback, refresh() only reads files whose stat changed
+                self._refresh_all()
+                next_poll = time.monotonic() + POLL_INTERVAL
+
+
+_watcher = None
+_watcher_lock = threading.Lock()
+
+
+def watch(path, parse, default=None):
+    """Cached, change-tracked parse(contents of path), see WatchedFile."""
+    global _watcher
+    with _watcher_lock:
+        if _watcher is None:
+            _watcher = FileWatcher()
+    return _watcher.watch(path, parse, default)
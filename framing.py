@@ -0,0 +1,163 @@
+import zlib
+import struct
+
+#
+# Fragment format of the state transfers (all little endian):
+#
+#   data fragment number n = section id * 256 + paket id, starting at 1:
+#     uint16 pLen, uint8 dataid, uint16 section id, uint8 paket id,
+#     payload, uint32 CRC32 over dataid .. payload
+#   header fragment, number 0 (section id 0, paket id 0):
+#     uint16 pLen, uint8 dataid, uint16 0, uint8 0,
+#     uint16 last section, uint8 last paket, uint32 CRC32 of the whole blob,
+#     [uint8 flags, only for clients that announced capabilities],
+#     uint32 CRC32 over dataid .. crc/flags
+#
+# pLen is the length of the whole fragment including pLen and CRC.
+#
+
+FragmentHead = struct.Struct("<HBHB")
+HeaderBody = struct.Struct("<HBI")
+Flags = struct.Struct("<B")
+Crc = struct.Struct("<I")
+
+# bytes a data fragment adds around its payload
+PACKET_OVERHEAD = FragmentHead.size + Crc.size
+HEADER_SIZE = FragmentHead.size + HeaderBody.size + Crc.size
+
+
+class FramingError(ValueError):
+    pass
+
+
+def fragment_count(blob_len, packet_size):
+    """Number of data fragments (without the header) for a blob."""
+    return (blob_len + packet_size - 1) // packet_size
+
+
+def blob_crc(header):
+    """CRC32 of the whole blob, as announced in a header fragment."""
+    return HeaderBody.unpack_from(header, FragmentHead.size)[2]
+
+
+def encode_fragments(blob, dataid, packet_size, flags=None):
+    """
+    Fragment blob and return the header followed by the data fragments.
+
+    All fragments are built in one preallocated buffer, the returned list
+    holds memoryview slices of it.
+    """
+    blob = memoryview(blob)
+    count = fragment_count(len(blob), packet_size)
+    header_size = HEADER_SIZE + (0 if flags is None else Flags.size)
+    buf = bytearray(header_size + count * PACKET_OVERHEAD + len(blob))
+    mv = memoryview(buf)
+    fragments = []
+
+    # header, the last fragment number defaults to section 0 paket 1
+    last_nr = max(count, 1)
+    FragmentHead.pack_into(buf, 0, header_size, dataid, 0, 0)
+    pos = FragmentHead.size
+    HeaderBody.pack_into(buf, pos, last_nr >> 8, last_nr & 0xFF,
+                         zlib.crc32(blob) & 0xFFFFFFFF)
+    pos += HeaderBody.size
+    if flags is not None:
+        Flags.pack_into(buf, pos, flags)
+        pos += Flags.size
+    Crc.pack_into(buf, pos, zlib.crc32(mv[2:pos]) & 0xFFFFFFFF)
+    fragments.append(mv[:header_size])
+
+    pack_head = FragmentHead.pack_into
+    pack_crc = Crc.pack_into
+    crc32 = zlib.crc32
+    head_size = FragmentHead.size
+    start = header_size
+    for nr in range(1, count + 1):
+        chunk = blob[(nr - 1) * packet_size:nr * packet_size]
+        size = PACKET_OVERHEAD + len(chunk)
+        pack_head(buf, start, size, dataid, nr >> 8, nr & 0xFF)
+        end = start + head_size + len(chunk)
+        mv[start + head_size:end] = chunk
+        pack_crc(buf, end, crc32(mv[start + 2:end]) & 0xFFFFFFFF)
+        fragments.append(mv[start:end + 4])
+        start = end + 4
+
+    return fragments
+
+
+def decode_fragment(fragment):
+    """
+    Check one fragment and return (dataid, number, body), where body is the
+    payload of a data fragment or the header fields after the fragment head.
+    Raises FramingError if length or CRC do not match.
+    """
+    fragment = memoryview(fragment)
+    if len(fragment) < PACKET_OVERHEAD:
+        raise FramingError(f"fragment too short: {len(fragment)} bytes")
+    p_len, dataid, section_id, paket_id = FragmentHead.unpack_from(fragment, 0)
+    if p_len != len(fragment):
+        raise FramingError(f"pLen {p_len} != fragment length {len(fragment)}")
+    crc, = Crc.unpack_from(fragment, p_len - Crc.size)
+    if zlib.crc32(fragment[2:p_len - Crc.size]) & 0xFFFFFFFF != crc:
+        raise FramingError("fragment CRC mismatch")
+    body = fragment[FragmentHead.size:p_len - Crc.size]
+    return dataid, section_id * 256 + paket_id, body
+
+
+class Reassembler:
+    """
+    Central-side streaming reassembler, the reference for app decoders.
+
+    Feed it notifications in any order with feed(); it returns the blob once
+    the header and all data fragments of a dataid arrived and the whole-blob
+    CRC matches. A fragment with another dataid starts a new transfer.
+    missing() lists the (section id, paket id) pairs still outstanding.
+    The header flags of the last returned blob are kept in blob_flags
+    (None for the old header without flags).
+    """
+
+    def __init__(self):
+        self.blob_flags = None
+        self.reset()
+
+    def reset(self, dataid=None):
+        self.dataid = dataid
+        self.last_nr = None
+        self.crc_full = None
+        self.flags = None
+        self.chunks = {}
+
+    def feed(self, fragment):
+        dataid, nr, body = decode_fragment(fragment)
+        if dataid != self.dataid:
+            self.reset(dataid)
+
+        if nr == 0:
+            if len(body) < HeaderBody.size:
+                raise FramingError("header fragment too short")
+            last_section, last_paket, self.crc_full = HeaderBody.unpack_from(body, 0)
+            self.last_nr = last_section * 256 + last_paket
+            if len(body) > HeaderBody.size:
+                self.flags = body[HeaderBody.size]
+        else:
+            self.chunks[nr] = bytes(body)
+
+        if self.last_nr is None or len(self.chunks) < self.last_nr:
+            return None
+        if any(nr not in self.chunks for nr in range(1, self.last_nr + 1)):
+            return None
+
+        blob = b"".join(self.chunks[nr] for nr in range(1, self.last_nr + 1))
+        if zlib.crc32(blob) & 0xFFFFFFFF != self.crc_full:
+            raise FramingError("blob CRC mismatch")
+        self.blob_flags = self.flags
+        self.reset(dataid)
+        return blob
+
+    def missing(self):
+        if self.last_nr is None:
+            return [(0, 0)]
+        return [
+            (nr >> 8, nr & 0xFF)
+            for nr in range(1, self.last_nr + 1) if nr not in self.chunks
+        ]
@@ -0,0 +1,128 @@
+import sys
+import array
+import struct
+import threading
+
+
+class HistoryRing:
+    """
+    Fixed-size ring of per-sensor samples, one sample every resolution_s
+    seconds of box time, depth samples deep, at most max_devices sensors
+    per sample. All storage is allocated up front (see nbytes), recording
+    overwrites the oldest sample. Sensors beyond max_devices are left out
+    of a sample, which is logged whenever that count changes.
+
+    Wire format of encode(), version 1 (all little endian):
+      Header: uint8 version, uint16 resolution_s, uint16 sample count (m)
+      m samples, oldest first, each:
+        SampleHead: uint32 unix time, uint8 sensor count (n)
+        uint32[n] serial, int16[n] bat_mV, int8[n] rssi,
+        uint32[n] missing_pkgs, uint8[n] flags (FLAG_*)
+    """
+
+    VERSION = 1
+    Header = struct.Struct("<BHH")
+    SampleHead = struct.Struct("<IB")
+    FLAG_ONLINE = 0x01
+    FLAG_MEASUREMENT = 0x02
+
+    def __init__(self, resolution_s=10, depth=2880, max_devices=35):
+        if not 0 < depth <= 0xFFFF:
+            raise ValueError("history depth must be 1..65535 samples")
+        self.resolution_s = resolution_s
+        self.depth = depth
+        self.max_devices = max_devices
+        slots = depth * max_devices
+        self.time = array.array('I', bytes(4 * depth))
+        self.count = array.array('B', bytes(depth))
+        self.serial = array.array('I', bytes(4 * slots))
+        self.bat_mV = array.array('h', bytes(2 * slots))
+        self.rssi = array.array('b', bytes(slots))
+        self.missing = array.array('I', bytes(4 * slots))
+        self.flags = array.array('B', bytes(slots))
+        # next sample to write and number of valid samples
+        self.head = 0
+        self.size = 0
+        self.last_time = None
+        # sensors the last sample had to leave out, to log changes only
+        self.truncated = 0
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        return sum(a.itemsize * len(a) for a in (
+            self.time, self.count, self.serial, self.bat_mV, self.rssi,
+            self.missing, self.flags))
+
+    def maybe_record(self, timestamp, devices):
+        """
+        Record the columnar devices view if resolution_s passed since the
+        last sample, or the clock went backwards. True if recorded.
+        """
+        last = self.last_time
+        if last is not None and last <= timestamp < last + self.resolution_s:
+            return False
+        self.record(timestamp, devices)
+        return True
+
+    def record(self, timestamp, devices):
+        n = min(len(devices['serial']), self.max_devices)
+        truncated = len(devices['serial']) - n
+        if truncated != self.truncated:
+            self.truncated = truncated
+            if truncated:
+                print(f"[History] {truncated} sensors beyond max_devices "
+                      f"{self.max_devices} are not recorded")
+        flags = bytes(
+            (self.FLAG_ONLINE if online else 0)
+            | (self.FLAG_MEASUREMENT if measurement else 0)
+            for online, measurement
+            in zip(devices['online'][:n], devices['measurement'][:n])
+        )
+        with self._lock:
+            i = self.head
+            start = i * self.max_devices
+            end = start + n
+            self.time[i] = timestamp & 0xFFFFFFFF
+            self.count[i] = n
+            self.serial[start:end] = array.array('I', devices['serial'][:n])
+            self.bat_mV[start:end] = array.array('h', devices['bat_mV'][:n])
+            self.rssi[start:end] = array.array('b', devices['rssi'][:n])
+            self.missing[start:end] = array.array('I', devices['n_missing_pkgs'][:n])
+            self.flags[start:end] = array.array('B', flags)
+            self.head = (i + 1) % self.depth
+            self.size = min(self.size + 1, self.depth)
+            self.last_time = timestamp
+
+    def _select(self, start_time, end_time, step):
+        """Ring indices of the samples in [start_time, end_time], oldest first."""
+        oldest = (self.head - self.size) % self.depth
+        selected = [
+            i for i in ((oldest + k) % self.depth for k in range(self.size))
+            if start_time <= self.time[i] <= end_time
+        ]
+        return selected[::max(1, step)]
+
+    @staticmethod
+    def _le(values):
+        if sys.byteorder != 'little':
+            values = array.array(values.typecode, values)
+            values.byteswap()
+        return values.tobytes()
+
+    def encode(self, start_time=0, end_time=0xFFFFFFFF, step=1):
+        """Encode every step-th sample within the time range, see above."""
+        with self._lock:
+            selected = self._select(start_time, end_time, step)
+            parts = [self.Header.pack(self.VERSION, self.resolution_s, len(selected))]
+            for i in selected:
+                n = self.count[i]
+                start = i * self.max_devices
+                end = start + n
+                parts.append(self.SampleHead.pack(self.time[i], n))
+                parts.append(self._le(self.serial[start:end]))
+                parts.append(self._le(self.bat_mV[start:end]))
+                parts.append(self.rssi[start:end].tobytes())
+                parts.append(self._le(self.missing[start:end]))
+                parts.append(self.flags[start:end].tobytes())
+        return b"".join(parts)
@@ -13,13 +13,18 @@
 #
 
 import time
+import argparse
 import dbus
+import dbus.bus
 import dbus.mainloop.glib
 import dbus.service
 from gi.repository import GLib
 
 
 from service_databox import DataboxService, DataboxAdvertisement
+from shm_read import ShmRead
+from history import HistoryRing
+import diagnostics
 
 from definitions import *
 
@@ -110,12 +115,37 @@ def register_app_error_cb(error):
     MAIN_LOOP.quit()
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Databox BLE GATT server")
+    parser.add_argument("--bus-address",
+                        help="D-Bus address to use instead of the system bus "
+                             "(e.g. a private bus running mock_bluez.py)")
+    parser.add_argument("--shm-path", help="shm segment, default /dev/shm/<shm-name>")
+    parser.add_argument("--shm-name", default=ShmRead.SHM_ADDRESS,
+                        help="name of the shm segment in /dev/shm")
+    parser.add_argument("--serial", type=int,
+                        help="box serial, default from /etc/gallopiq/databox_sn")
+    parser.add_argument("--history-resolution", type=int, default=10,
+                        help="seconds between history samples")
+    parser.add_argument("--history-depth", type=int, default=2880,
+                        help="history samples kept, 0 disables the history")
+    parser.add_argument("--history-devices", type=int, default=None,
+                        help="sensors kept per history sample "
+                             "(default: as many as the shm segment holds)")
+    return parser.parse_args()
+
+
 def main():
     global MAIN_LOOP
 
+    args = parse_args()
+
     dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
 
-    bus = dbus.SystemBus()
+    if args.bus_address:
+        bus = dbus.bus.BusConnection(args.bus_address)
+    else:
+        bus = dbus.SystemBus()
 
     adapter = find_adapter(bus)
     if not adapter:
@@ -131,13 +161,27 @@ def main():
         LE_ADVERTISING_MANAGER_IFACE
     )
 
+    shm = ShmRead(args.shm_path, args.serial, args.shm_name)
+    if args.history_depth:
+        shm.history = HistoryRing(args.history_resolution, args.history_depth,
+                                  args.history_devices or shm.capacity)
+        print(f"History: {args.history_depth} samples every "
+              f"{args.history_resolution}s of {shm.history.max_devices} "
+              f"sensors, {shm.history.nbytes // 1024} KiB")
+
     app = Application(bus)
-    app.add_service(DataboxService(bus, 0))
+    app.add_service(DataboxService(bus, 0, shm))
 
-    advertisement = DataboxAdvertisement(bus, 0)
+    advertisement = DataboxAdvertisement(bus, 0, args.serial)
 
     MAIN_LOOP = GLib.MainLoop()
 
+    try:
+        stats_server = diagnostics.StatsServer()
+    except OSError as e:
+        print(f"Stats socket not available: {e}")
+        stats_server = None
+
     print("Registering advertisement FIRST...")
     advertising_manager.RegisterAdvertisement(
         advertisement.get_path(),
@@ -162,6 +206,8 @@ def main():
         print("GATT server stopped")
     finally:
         unregister_advertisement(advertising_manager, advertisement)
+        if stats_server is not None:
+            stats_server.close()
 
 
 if __name__ == '__main__':
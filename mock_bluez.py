@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+#
+# Stand-in for BlueZ on a private D-Bus bus, for end-to-end latency tests
+# of the GATT server without Bluetooth hardware.
+#
+# Starts a private dbus-daemon, claims org.bluez on it with one adapter that
+# implements GattManager1 and LEAdvertisingManager1, runs main.py against it
+# on a simulated shm segment and then behaves like a phone: it announces a
+# connected device, calls StartNotify and repeatedly writes the state
+# request, timestamping every PropertiesChanged it receives.
+#
+#   python3 mock_bluez.py --devices 16 --requests 50 --mtu 247
+#
+
+import os
+import sys
+import time
+import argparse
+import threading
+import subprocess
+
+import dbus
+import dbus.bus
+import dbus.service
+import dbus.mainloop.glib
+from gi.repository import GLib
+
+from definitions import *
+from framing import Reassembler
+from shm_sim import ShmSimulator
+from service_databox import DataboxService
+
+ADAPTER_PATH = '/org/bluez/hci0'
+DEVICE_PATH = ADAPTER_PATH + '/dev_00_11_22_33_44_55'
+ADAPTER_IFACE = 'org.bluez.Adapter1'
+
+STATE_REQUEST = b"\xff\xff\xff\xff"
+
+
+def start_private_bus():
+    """Start a dbus-daemon for this test only, return (process, address)."""
+    proc = subprocess.Popen(
+        ["dbus-daemon", "--session", "--nofork", "--print-address"],
+        stdout=subprocess.PIPE, text=True
+    )
+    address = proc.stdout.readline().strip()
+    return proc, address
+
+
+def percentile(sorted_values, p):
+    idx = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+class MockDevice(dbus.service.Object):
+    """org.bluez.Device1 of the simulated phone, only Connected is modelled."""
+
+    def __init__(self, bus):
+        dbus.service.Object.__init__(self, bus, DEVICE_PATH)
+
+    @dbus.service.signal(DBUS_PROP_IFACE, signature='sa{sv}as')
+    def PropertiesChanged(self, interface, changed, invalidated):
+        pass
+
+    def set_connected(self, connected):
+        self.PropertiesChanged(DEVICE_IFACE,
+                               {'Connected': dbus.Boolean(connected)}, [])
+
+
+class MockAdapter(dbus.service.Object):
+    """
+    org.bluez adapter with GattManager1 and LEAdvertisingManager1.
+
+    On RegisterApplication it reads the application's objects with
+    GetManagedObjects and hands them to on_application.
+    """
+
+    def __init__(self, bus, on_application):
+        self.bus = bus
+        self.on_application = on_application
+        self.advertisements = {}
+        dbus.service.Object.__init__(self, bus, ADAPTER_PATH)
+
+    def get_interfaces(self):
+        return {
+            ADAPTER_IFACE: {'Address': '00:00:00:00:00:01', 'Powered': True},
+            GATT_MANAGER_IFACE: {},
+            LE_ADVERTISING_MANAGER_IFACE: {},
+        }
+
+    @dbus.service.method(GATT_MANAGER_IFACE, in_signature='oa{sv}',
+                         sender_keyword='sender')
+    def RegisterApplication(self, application, options, sender=None):
+        print(f"[MockBluez] RegisterApplication {application} from {sender}")
+        # reply first, like BlueZ, then walk the application
+        GLib.idle_add(self._read_application, sender, application)
+
+    @dbus.service.method(GATT_MANAGER_IFACE, in_signature='o')
+    def UnregisterApplication(self, application):
+        print(f"[MockBluez] UnregisterApplication {application}")
+
+    @dbus.service.method(LE_ADVERTISING_MANAGER_IFACE, in_signature='oa{sv}',
+                         sender_keyword='sender')
+    def RegisterAdvertisement(self, advertisement, options, sender=None):
+        props = self.bus.get_object(sender, advertisement).GetAll(
+            LE_ADVERTISEMENT_IFACE, dbus_interface=DBUS_PROP_IFACE)
+        self.advertisements[str(advertisement)] = props
+        print(f"[MockBluez] RegisterAdvertisement {advertisement}: "
+              f"{props.get('LocalName')}")
+
+    @dbus.service.method(LE_ADVERTISING_MANAGER_IFACE, in_signature='o')
+    def UnregisterAdvertisement(self, advertisement):
+        self.advertisements.pop(str(advertisement), None)
+
+    def _read_application(self, sender, application):
+        om = dbus.Interface(self.bus.get_object(sender, application), DBUS_OM_IFACE)
+        self.on_application(sender, om.GetManagedObjects())
+        return False
+
+
+class MockRoot(dbus.service.Object):
+    """org.freedesktop.DBus.ObjectManager at / listing the adapter."""
+
+    def __init__(self, bus, adapter):
+        self.adapter = adapter
+        dbus.service.Object.__init__(self, bus, '/')
+
+    @dbus.service.method(DBUS_OM_IFACE, out_signature='a{oa{sa{sv}}}')
+    def GetManagedObjects(self):
+        return {dbus.ObjectPath(ADAPTER_PATH): self.adapter.get_interfaces()}
+
+
+class PhoneClient:
+    """
+    Drives the state characteristic like the app does and measures
+    request -> first fragment and request -> complete blob.
+    """
+
+    def __init__(self, bus, device, requests, mtu, loop):
+        self.bus = bus
+        self.device = device
+        self.requests = requests
+        self.mtu = mtu
+        self.loop = loop
+        self.reassembler = Reassembler()
+        self.chrc = None
+        self.notifications = []
+        self.first_fragment = []
+        self.transfer = []
+        self._request_time = None
+        self._got_first = False
+
+    def on_application(self, sender, objects):
+        for path, interfaces in objects.items():
+            props = interfaces.get(GATT_CHRC_IFACE)
+            if props and str(props['UUID']) == DataboxService.DATABOX_STATE_UUID:
+                self.chrc = self.bus.get_object(sender, path)
+                break
+        if self.chrc is None:
+            print("[MockBluez] state characteristic not found")
+            self.loop.quit()
+            return
+
+        self.bus.add_signal_receiver(
+            self._on_properties_changed,
+            signal_name='PropertiesChanged',
+            dbus_interface=DBUS_PROP_IFACE,
+            bus_name=sender,
+            path=self.chrc.object_path
+        )
+        self.device.set_connected(True)
+        self.chrc.StartNotify(dbus_interface=GATT_CHRC_IFACE,
+                              reply_handler=lambda: None,
+                              error_handler=self._on_error)
+        # give the poller a moment to precompute, like a phone after connecting
+        GLib.timeout_add(500, self._request)
+
+    def _request(self):
+        if len(self.transfer) >= self.requests:
+            self.report()
+            self.loop.quit()
+            return False
+        self._got_first = False
+        self._request_time = time.perf_counter()
+        self.chrc.WriteValue(
+            dbus.Array(STATE_REQUEST, signature='y'),
+            {'device': dbus.ObjectPath(DEVICE_PATH), 'mtu': dbus.UInt16(self.mtu)},
+            dbus_interface=GATT_CHRC_IFACE,
+            reply_handler=lambda: None,
+            error_handler=self._on_error
+        )
+        return False
+
+    def _on_properties_changed(self, interface, changed, invalidated):
+        if 'Value' not in changed:
+            return
+        now = time.perf_counter()
+        self.notifications.append(now)
+        if self._request_time is None:
+            return
+        if not self._got_first:
+            self._got_first = True
+            self.first_fragment.append(now - self._request_time)
+        if self.reassembler.feed(bytes(changed['Value'])) is not None:
+            self.transfer.append(now - self._request_time)
+            self._request_time = None
+            GLib.timeout_add(50, self._request)
+
+    def _on_error(self, error):
+        print(f"[MockBluez] call failed: {error}")
+        self.loop.quit()
+
+    def report(self):
+        for name, samples in (("request -> first fragment", self.first_fragment),
+                              ("request -> full transfer", self.transfer)):
+            values = sorted(samples)
+            if not values:
+                print(f"{name}: no samples")
+                continue
+            print(f"{name:<28} p50 {percentile(values, 50) * 1e3:7.2f} ms"
+                  f"  p90 {percentile(values, 90) * 1e3:7.2f} ms"
+                  f"  max {values[-1] * 1e3:7.2f} ms  (n={len(values)})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock BlueZ latency test")
+    parser.add_argument("--devices", type=int, default=16, help="simulated sensors")
+    parser.add_argument("--rate", type=float, default=10.0, help="shm updates per second")
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--mtu", type=int, default=247)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    args = parser.parse_args()
+
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    daemon, address = start_private_bus()
+    sim = ShmSimulator(num_devices=args.devices)
+    writer = threading.Thread(target=sim.run, args=(args.rate,), daemon=True)
+    writer.start()
+    server = None
+    try:
+        bus = dbus.bus.BusConnection(address)
+        loop = GLib.MainLoop()
+        name = dbus.service.BusName(BLUEZ_SERVICE_NAME, bus)
+
+        device = MockDevice(bus)
+        client = PhoneClient(bus, device, args.requests, args.mtu, loop)
+        adapter = MockAdapter(bus, client.on_application)
+        root = MockRoot(bus, adapter)
+
+        server = subprocess.Popen([
+            sys.executable, os.path.join(os.path.dirname(__file__), "main.py"),
+            "--bus-address", address, "--shm-path", sim.path, "--serial", "1"
+        ])
+        GLib.timeout_add(int(args.timeout * 1000), loop.quit)
+        loop.run()
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        sim.stop()
+        writer.join()
+        sim.close(unlink=True)
+        daemon.terminate()
+        daemon.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+import time
+
+
+class Pacer:
+    """
+    Pacing policy for fragment notifications.
+
+    The characteristic calls fragments_per_tick() on every timer tick (every
+    interval_ms) and sends up to that many fragments back-to-back. It reports
+    how many went out with on_tick(sent, blocked), blocked being True when
+    the socket or D-Bus could not take another fragment. A blocked tick
+    makes the pacer skip the next backoff ticks, doubling up to max_backoff
+    while the link keeps refusing fragments.
+
+    The base class sends a fixed burst per tick; Pacer(40, 1) is the old one
+    fragment per 40 ms behaviour.
+    """
+
+    def __init__(self, interval_ms=40, burst=1, max_backoff=16):
+        self.interval_ms = interval_ms
+        self.burst = burst
+        self.max_backoff = max_backoff
+        self.backoff = 0
+        self._skip = 0
+        self._start = None
+        self._count = 0
+        self.fragments_per_second = 0.0
+
+    def fragments_per_tick(self):
+        if self._skip > 0:
+            self._skip -= 1
+            return 0
+        return self.burst
+
+    def on_tick(self, sent, blocked=False):
+        if sent and self._start is None:
+            self._start = time.monotonic()
+        self._count += sent
+        if blocked:
+            self.backoff = min(max(1, self.backoff * 2), self.max_backoff)
+            self._skip = self.backoff
+        elif sent:
+            self.backoff = 0
+
+    def on_transfer_done(self):
+        """
+        Finish the throughput measurement of the current transfer. Returns
+        its fragments per second, None if no fragment went out.
+        """
+        rate = None
+        if self._start is not None:
+            elapsed = time.monotonic() - self._start
+            # the first fragment left at _start, count the interval it took
+            elapsed += self.interval_ms / 1000
+            rate = self.fragments_per_second = self._count / elapsed
+        self._start = None
+        self._count = 0
+        self._skip = 0
+        return rate
+
+
+class AdaptivePacer(Pacer):
+    """
+    Additive increase / multiplicative decrease of the burst size.
+
+    Every tick that sends a full burst without blocking grows the burst by
+    one up to max_burst, a blocked tick halves it and backs off like Pacer.
+    With max_burst large this sends back-to-back until the link pushes back.
+    """
+
+    def __init__(self, interval_ms=20, burst=2, max_burst=16, max_backoff=16):
+        super().__init__(interval_ms, burst, max_backoff)
+        self.max_burst = max_burst
+
+    def on_tick(self, sent, blocked=False):
+        super().on_tick(sent, blocked)
+        if blocked:
+            self.burst = max(1, self.burst // 2)
+        elif sent >= self.burst and self.burst < self.max_burst:
+            self.burst += 1
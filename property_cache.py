@@ -0,0 +1,49 @@
+#
+# Cached D-Bus property dictionaries for the GATT objects.
+#
+# BlueZ reads the properties of every object again on each (re)connect, via
+# GetManagedObjects, Get and GetAll. The marshalled dict is built once by
+# build_properties() and served from the cache until something changes.
+#
+
+class PropertyCache:
+    """
+    Mixin for Service, Characteristic and Advertisement.
+
+    Subclasses implement build_properties() and set PROPERTIES_IFACE, and
+    call invalidate_properties() whenever something build_properties()
+    reads has changed. That drops the cache; if the cache was in use,
+    PropertiesChanged is emitted for the entries that actually differ.
+    """
+
+    PROPERTIES_IFACE = None
+
+    _properties = None
+
+    def build_properties(self):
+        raise NotImplementedError()
+
+    def get_properties(self):
+        props = self._properties
+        if props is None:
+            props = self._properties = self.build_properties()
+        return props
+
+    def invalidate_properties(self):
+        old = self._properties
+        if old is None:
+            # nobody has seen the properties yet, nothing to announce
+            return
+        self._properties = None
+        old = old[self.PROPERTIES_IFACE]
+        new = self.get_properties()[self.PROPERTIES_IFACE]
+        changed = {name: value for name, value in new.items()
+                   if name not in old or old[name] != value}
+        invalidated = [name for name in old if name not in new]
+        if changed or invalidated:
+            self.PropertiesChanged(self.PROPERTIES_IFACE, changed, invalidated)
+
+    def set_property(self, name, value):
+        """Update a single entry in place and announce it."""
+        self.get_properties()[self.PROPERTIES_IFACE][name] = value
+        self.PropertiesChanged(self.PROPERTIES_IFACE, {name: value}, [])
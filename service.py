@@ -1,13 +1,16 @@
 import dbus
 
 from definitions import *
+from property_cache import PropertyCache
 
 
-class Service(dbus.service.Object):
+class Service(PropertyCache, dbus.service.Object):
     """
     org.bluez.GattService1 implementation
     """
 
+    PROPERTIES_IFACE = GATT_SERVICE_IFACE
+
     def __init__(self, bus, index, uuid, primary):
         self.path = f'/databox/service{index}'
         self.bus = bus
@@ -16,7 +19,7 @@ class Service(dbus.service.Object):
         self.characteristics = []
         dbus.service.Object.__init__(self, bus, self.path)
 
-    def get_properties(self):
+    def build_properties(self):
         return {
             GATT_SERVICE_IFACE: {
                 'UUID': self.uuid,
@@ -33,7 +36,12 @@ class Service(dbus.service.Object):
 
     def add_characteristic(self, characteristic):
         self.characteristics.append(characteristic)
+        self.invalidate_properties()
 
     def get_characteristics(self):
         return self.characteristics
 
+    @dbus.service.signal(DBUS_PROP_IFACE,
+                         signature='sa{sv}as')
+    def PropertiesChanged(self, interface, changed, invalidated):
+        pass
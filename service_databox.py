@@ -1,10 +1,15 @@
 import dbus
+from gi.repository import GLib
 
+import file_watch
 from definitions import *
 from uuidDataboxStateChar import DataboxStateCharacteristic
 from uuidDataboxTimeChar import DataboxTimeCharacteristic
 from uuidDataboxMeasureChar import DataboxMeasureCharacteristic
+from uuidDataboxDiagChar import DataboxDiagnosticsCharacteristic
+from uuidDataboxStatusChar import DataboxStatusCharacteristic
 from characteristic import Advertisement
+from shm_read import ShmRead, parse_serial
 
 from service import Service
 
@@ -20,12 +25,18 @@ class DataboxService(Service):
     DATABOX_STATE_UUID = 'f6dd9ec5-281f-4ad3-a1b3-c2957ad11738'
     DATABOX_TIME_UUID = 'f6dd9ec5-281f-4ad3-a1b3-c2957ad11739'
     DATABOX_MEASURE_UUID = 'f6dd9ec5-281f-4ad3-a1b3-c2957ad11740'
+    DATABOX_DIAG_UUID = 'f6dd9ec5-281f-4ad3-a1b3-c2957ad11741'
+    DATABOX_STATUS_UUID = 'f6dd9ec5-281f-4ad3-a1b3-c2957ad11742'
 
-    def __init__(self, bus, index):
+    def __init__(self, bus, index, shm=None):
         Service.__init__(self, bus, index, self.DATABOX_SERVICE_UUID, True)
-        self.add_characteristic(DataboxStateCharacteristic(bus, "state", self.DATABOX_STATE_UUID, self))
+        self.shm = shm or ShmRead()
+        state = DataboxStateCharacteristic(bus, "state", self.DATABOX_STATE_UUID, self, self.shm)
+        self.add_characteristic(state)
         self.add_characteristic(DataboxTimeCharacteristic(bus, "time", self.DATABOX_TIME_UUID, self))
         self.add_characteristic(DataboxMeasureCharacteristic(bus, "measure", self.DATABOX_MEASURE_UUID, self))
+        self.add_characteristic(DataboxDiagnosticsCharacteristic(bus, "diagnostics", self.DATABOX_DIAG_UUID, self))
+        self.add_characteristic(DataboxStatusCharacteristic(bus, "status", self.DATABOX_STATUS_UUID, self, self.shm, state))
 
         
 
@@ -34,10 +45,20 @@ class DataboxAdvertisement(Advertisement):
     Advertises the custom ExampleService UUID so scanners can discover it.
     """
 
-    def __init__(self, bus, index=0):
+    def __init__(self, bus, index=0, serial=None):
         super().__init__(bus, index, advertising_type='peripheral')
         self.add_service_uuid(DataboxService.DATABOX_SERVICE_UUID)
         self.include_tx_power = True
         self.local_name = "CalvaraDev"
-        with open("/etc/gallopiq/databox_sn", "r") as file:
-            self.local_name = f"Calvara{file.read()}"
\ No newline at end of file
+        if serial is None:
+            # follow the serial file, it may only be provisioned after boot
+            watched = file_watch.watch(DATABOX_SN_FILE, parse_serial)
+            watched.add_listener(
+                lambda serial: GLib.idle_add(self.set_serial, serial))
+            serial = watched.get()
+        self.set_serial(serial)
+
+    def set_serial(self, serial):
+        # assigning local_name announces the change to BlueZ
+        self.local_name = "CalvaraDev" if serial is None else f"Calvara{serial}"
+        return False
\ No newline at end of file
@@ -0,0 +1,98 @@
+import threading
+
+
+class ShmPoller:
+    """
+    Single long-lived worker thread that watches the shm heartbeat.
+
+    Every interval_ms the poller compares heartbeat/shm_timestamp with the
+    last seen values and, when they moved, runs shm.update_data(). If the
+    encoded packet changed, on_change() is called from the worker thread.
+    The poller starts paused; resume() it while a central is connected.
+    While paused and idle_interval_ms is set, shm.update_data() still runs
+    that often (to keep sampling shm.history), without on_change().
+    """
+
+    def __init__(self, shm, on_change, interval_ms=100, idle_interval_ms=None):
+        self.shm = shm
+        self.on_change = on_change
+        self.interval_ms = interval_ms
+        self.idle_interval_ms = idle_interval_ms
+        self._active = threading.Event()
+        self._stopped = threading.Event()
+        # set while the last poll since resume() succeeded
+        self._fresh = threading.Event()
+        self._last_version = None
+        # report the next poll even if the packet did not change, shm may
+        # have been updated while paused
+        self._force = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._active.set()
+        self._thread.join()
+
+    def resume(self):
+        if not self._active.is_set():
+            self._fresh.clear()
+            self._force = True
+            self._active.set()
+
+    def pause(self):
+        self._active.clear()
+        self._fresh.clear()
+
+    def set_interval(self, interval_ms):
+        self.interval_ms = interval_ms
+
+    def is_fresh(self):
+        """True if the precomputed data reflects the current segment."""
+        return self._fresh.is_set()
+
+    def poll(self):
+        """Check the heartbeat once, update and report a changed packet."""
+        version = self.shm.get_version()
+        if version == self._last_version and not self._force:
+            return False
+        self._last_version = version
+        if not self.shm.update_data() and not self._force:
+            return False
+        if not self.shm.has_data():
+            # nothing decoded yet, keep forcing until a snapshot is
+            self._last_version = None
+            return False
+        self.on_change()
+        self._force = False
+        return True
+
+    def _idle_poll(self):
+        """Wait while paused, sampling shm every idle_interval_ms."""
+        if self.idle_interval_ms is None:
+            self._active.wait()
+            return
+        if self._active.wait(self.idle_interval_ms / 1000):
+            return
+        try:
+            self.shm.update_data()
+        except Exception as e:
+            print(f"[ShmPoller] idle poll failed: {e}")
+
+    def _run(self):
+        while not self._stopped.is_set():
+            if not self._active.is_set():
+                self._idle_poll()
+                continue
+            try:
+                self.poll()
+            except Exception as e:
+                # requests read shm themselves until a poll succeeds
+                print(f"[ShmPoller] poll failed: {e}")
+                self._fresh.clear()
+            else:
+                if self.shm.has_data():
+                    self._fresh.set()
+            self._stopped.wait(self.interval_ms / 1000)
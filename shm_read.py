@@ -3,6 +3,19 @@ import mmap
 import struct
 import threading
 import msgpack
+from time import perf_counter, sleep
+
+import diagnostics
+import file_watch
+from definitions import ONLINE_STATUS_FILE, DATABOX_SN_FILE
+
+
+def parse_online_status(text):
+    return text.startswith("Online")
+
+
+def parse_serial(text):
+    return int(text)
 
 
 def decode_header(raw):        
@@ -17,7 +30,7 @@ def decode_header(raw):
             bat_mv,
             usb_mV,
             bat_percent
-        ) = ShmRead.ShmHeader.unpack(raw[:ShmRead.ShmHeader.size])
+        ) = ShmRead.ShmHeader.unpack_from(raw, 0)
 
         return {
             "heartbeat":       (hb_sec, hb_usec),
@@ -49,9 +62,7 @@ def decode_device_data(raw, offset):
         bat_mV,
         usb_mV,
         rssi
-    ) = ShmRead.ShmDevice.unpack(
-        raw[offset_bytes:offset_bytes + ShmRead.ShmDevice.size]
-    )
+    ) = ShmRead.ShmDevice.unpack_from(raw, offset_bytes)
 
     return {
         "serial": serial,
@@ -69,62 +80,375 @@ def decode_device_data(raw, offset):
         "rssi": rssi
     }
 
+
+DEVICE_FIELDS = (
+    "serial",
+    "online",
+    "measurement",
+    "x_min",
+    "x_max",
+    "y_min",
+    "y_max",
+    "z_min",
+    "z_max",
+    "n_missing_pkgs",
+    "bat_mV",
+    "usb_mV",
+    "rssi",
+)
+
+
+def decode_devices(raw, num_devices):
+    """
+    Decode the first num_devices device records in one pass.
+
+    Returns a columnar view: a dict mapping every name in DEVICE_FIELDS to a
+    tuple with one entry per device, e.g. columns["bat_mV"][i].
+    """
+    start = ShmRead.ShmHeader.size
+    end = start + num_devices * ShmRead.ShmDevice.size
+    rows = ShmRead.ShmDevice.iter_unpack(memoryview(raw)[start:end])
+    columns = tuple(zip(*rows))
+    if not columns:
+        columns = ((),) * len(DEVICE_FIELDS)
+    return dict(zip(DEVICE_FIELDS, columns))
+
+
+def columns_to_sensors(columns):
+    """Turn a columnar device view back into a list of per-device dicts."""
+    return [
+        dict(zip(DEVICE_FIELDS, row))
+        for row in zip(*(columns[name] for name in DEVICE_FIELDS))
+    ]
+
+
+def encode_delta(base, current, base_id):
+    """
+    Encode the changes from packet dict base to packet dict current.
+
+    The result is a msgpack map carrying "delta": base_id, every top-level
+    field whose value differs from base, "sensors" with the full entries of
+    sensors that are new or changed (matched by serial) and "removed" with
+    the serials that are no longer present.
+    """
+    delta = {"delta": base_id}
+    for key, value in current.items():
+        if key != "sensors" and base.get(key) != value:
+            delta[key] = value
+
+    base_sensors = {s["serial"]: s for s in base.get("sensors", [])}
+    current_serials = set()
+    changed = []
+    for sensor in current["sensors"]:
+        current_serials.add(sensor["serial"])
+        if base_sensors.get(sensor["serial"]) != sensor:
+            changed.append(sensor)
+
+    delta["sensors"] = changed
+    delta["removed"] = [
+        serial for serial in base_sensors if serial not in current_serials
+    ]
+    return msgpack.packb(delta, use_bin_type=True)
+
+
+# Sensor fields of the msgpack state that a filter can select, bit i of
+# a field mask stands for SENSOR_FIELDS[i]. "serial" is always sent.
+SENSOR_FIELDS = (
+    "online",
+    "measurement",
+    "bat_mV",
+    "usb_connected",
+    "rssi",
+    "missing_pkgs",
+)
+ALL_SENSOR_FIELDS = (1 << len(SENSOR_FIELDS)) - 1
+
+
+def filter_packet_dict(packet_dict, serials=None, field_mask=ALL_SENSOR_FIELDS):
+    """
+    Return packet_dict with only the sensors whose serial is in serials
+    (all if None) and only the sensor fields selected by field_mask.
+    num_devices still counts all devices of the box.
+    """
+    sensors = packet_dict["sensors"]
+    if serials is not None:
+        sensors = [s for s in sensors if s["serial"] in serials]
+    if field_mask & ALL_SENSOR_FIELDS != ALL_SENSOR_FIELDS:
+        keep = ("serial",) + tuple(
+            name for i, name in enumerate(SENSOR_FIELDS) if field_mask & (1 << i))
+        sensors = [{name: s[name] for name in keep} for s in sensors]
+    return dict(packet_dict, sensors=sensors)
+
+
+# usb_mV above this counts as usb_connected
+USB_CONNECTED_MV = 4300
+
+# Columnar wire format, version 1 (all little endian):
+#   ColumnarHeader: uint8 version, uint32 box serial, int64 measure_start
+#                   sec + usec, uint8 num_devices (n), uint8 diskspace_percent,
+#                   int16 bat_mv, uint8 flags (COLUMNAR_USB, COLUMNAR_ONLINE)
+#   uint32[n] serial, int16[n] bat_mV, int8[n] rssi, uint32[n] missing_pkgs
+#   online, measurement and usb_connected bitmaps of (n + 7) // 8 bytes each,
+#   sensor i in bit i % 8 of byte i // 8
+COLUMNAR_VERSION = 1
+ColumnarHeader = struct.Struct("<BIqqBBhB")
+COLUMNAR_USB = 0x01
+COLUMNAR_ONLINE = 0x02
+
+
+def pack_bits(values):
+    bits = bytearray((len(values) + 7) // 8)
+    for i, value in enumerate(values):
+        if value:
+            bits[i >> 3] |= 1 << (i & 7)
+    return bytes(bits)
+
+
+def encode_columnar(databox, devices, serial):
+    """Encode a decoded snapshot in the columnar wire format."""
+    n = databox['num_devices']
+    flags = 0
+    if databox['usb_mV'] > USB_CONNECTED_MV:
+        flags |= COLUMNAR_USB
+    if databox['online']:
+        flags |= COLUMNAR_ONLINE
+    ms_sec, ms_usec = databox['measure_start']
+    return b"".join((
+        ColumnarHeader.pack(
+            COLUMNAR_VERSION, serial, ms_sec, ms_usec, n,
+            databox['diskspace_percent'], databox['bat_mv'], flags
+        ),
+        struct.pack(f"<{n}I", *devices['serial']),
+        struct.pack(f"<{n}h", *devices['bat_mV']),
+        struct.pack(f"<{n}b", *devices['rssi']),
+        struct.pack(f"<{n}I", *devices['n_missing_pkgs']),
+        pack_bits(devices['online']),
+        pack_bits(devices['measurement']),
+        pack_bits([usb_mV > USB_CONNECTED_MV for usb_mV in devices['usb_mV']]),
+    ))
+
+
+# Status, version 1, 12 bytes + two bitmaps (all little endian). Up to 35
+# devices that is at most 22 bytes and fits a single ATT read at the
+# default MTU of 23. Larger segments (up to ShmRead.DEVICE_LIMIT, 76 bytes)
+# need a larger MTU or a long read: the central reads on at the offset it
+# got so far, which ReadValue honours.
+#   StatusHeader: uint8 version, uint8 flags (STATUS_*), uint8 num_devices (n),
+#                 uint8 bat_percent, int16 bat_mv, uint8 diskspace_percent,
+#                 uint8 dataid of the current state (STATUS_NO_DATAID if none),
+#                 uint32 measure_start sec (0 when not measuring)
+#   online and measurement bitmaps of (n + 7) // 8 bytes each, as in the
+#   columnar format
+STATUS_VERSION = 1
+StatusHeader = struct.Struct("<BBBBhBBI")
+STATUS_MEASURING = 0x01
+STATUS_USB = 0x02
+STATUS_ONLINE = 0x04
+STATUS_NO_DATAID = 0xFF
+
+
+def encode_status(raw, online, dataid=STATUS_NO_DATAID):
+    """
+    Encode the status from a raw segment copy. Only the header is unpacked,
+    the device flags are taken from the records with strided slices.
+    """
+    (_, _, _, _, ms_sec, _, n, _, disk_percent, bat_mv, usb_mV,
+     bat_percent) = ShmRead.ShmHeader.unpack_from(raw, 0)
+    flags = 0
+    if ms_sec:
+        flags |= STATUS_MEASURING
+    if usb_mV > USB_CONNECTED_MV:
+        flags |= STATUS_USB
+    if online:
+        flags |= STATUS_ONLINE
+    size = ShmRead.ShmDevice.size
+    start = ShmRead.ShmHeader.size
+    end = start + n * size
+    return b"".join((
+        StatusHeader.pack(STATUS_VERSION, flags, n, bat_percent, bat_mv,
+                          disk_percent, dataid, max(0, ms_sec) & 0xFFFFFFFF),
+        pack_bits(raw[start + ShmRead.DEVICE_ONLINE_OFFSET:end:size]),
+        pack_bits(raw[start + ShmRead.DEVICE_MEASUREMENT_OFFSET:end:size]),
+    ))
+
+
 class ShmRead:
     SHM_ADDRESS = "gallopiq_shm"
+    # size of the segment written by the acquisition daemon by default; the
+    # mapping follows the actual size of the segment
     SHM_SIZE = 1024
     ShmHeader = struct.Struct("<qqqqqqBIBhhB")
     ShmDevice = struct.Struct("<I??hhhhhhIhhb")
-    
-    def __init__(self):
-        self.path = f"/dev/shm/{self.SHM_ADDRESS}"
+    # heartbeat + shm_timestamp, used as the seqlock version of the segment
+    ShmVersion = struct.Struct("<qqqq")
+    NUM_DEVICES_OFFSET = 48
+    # online / measurement flag inside a device record
+    DEVICE_ONLINE_OFFSET = 4
+    DEVICE_MEASUREMENT_OFFSET = 5
+    # devices that fit a segment of SHM_SIZE
+    MAX_DEVICES = (SHM_SIZE - ShmHeader.size) // ShmDevice.size
+    # num_devices is a uint8
+    DEVICE_LIMIT = 255
+    SNAPSHOT_RETRIES = 8
+    # seconds between snapshot attempts while a write is in progress
+    SNAPSHOT_RETRY_DELAY = 0.0005
+
+    @classmethod
+    def segment_size(cls, num_devices):
+        """Bytes a segment with num_devices device records needs."""
+        return cls.ShmHeader.size + num_devices * cls.ShmDevice.size
+
+    def __init__(self, path=None, serial=None, name=SHM_ADDRESS, history=None):
+        """
+        path defaults to /dev/shm/<name>, serial to the box serial
+        from /etc/gallopiq/databox_sn. history is an optional
+        history.HistoryRing that update_data samples into.
+        """
+        self.path = path or f"/dev/shm/{name}"
         self._lock = threading.Lock()
+        # serializes update_data between the poller and request threads
+        self._update_lock = threading.Lock()
         self.databox = {}
-        self.sensors = []
+        self.devices = decode_devices(b"", 0)
         self.packet = b"42"
-        self.serial = self.get_databox_serial()
+        self.packet_dict = {}
+        self.raw = b""
+        # snapshot content without heartbeat/shm_timestamp, see update_data
+        self._content_key = None
+        # file-backed inputs, cached and refreshed by the file watcher
+        self._online = file_watch.watch(ONLINE_STATUS_FILE, parse_online_status, False)
+        self._serial_file = file_watch.watch(DATABOX_SN_FILE, parse_serial)
+        self._serial = serial
+        self.history = history
+
+        # num_devices last clamped to, to warn only once
+        self._clamped = None
 
         self.fd = os.open(self.path, os.O_RDONLY)
+        self.size = 0
+        self.capacity = 0
+        self.map_segment()
+
+    def map_segment(self):
+        """
+        Map the whole segment as large as it currently is. Returns True if
+        the mapping changed.
 
-        self.mm = mmap.mmap(
-            self.fd,
-            self.SHM_SIZE,
-            access=mmap.ACCESS_READ
-        )
+        Readers in other threads may still hold the previous memoryview;
+        it is not released explicitly, the old mapping goes away with the
+        last reference to it.
+        """
+        size = os.fstat(self.fd).st_size
+        if size == self.size:
+            return False
+        if size < self.ShmHeader.size:
+            raise ValueError(f"{self.path}: segment of {size} bytes has no header")
+        mm = mmap.mmap(self.fd, size, access=mmap.ACCESS_READ)
+        self.mm = mm
+        self.mv = memoryview(mm)
+        self.size = size
+        self.capacity = min(self.DEVICE_LIMIT,
+                            (size - self.ShmHeader.size) // self.ShmDevice.size)
+        print(f"[ShmRead] mapped {size} bytes of {self.path}, "
+              f"room for {self.capacity} devices")
+        return True
 
-    def get_bytes(self, n=SHM_SIZE):
-        """Return first n bytes of the shared memory."""
+    def get_bytes(self, n=None):
+        """Return first n bytes of the shared memory, all if n is None."""
         return self.mm[:n]
+
+    def get_version(self):
+        """Return (heartbeat, shm_timestamp) read straight from the mapping."""
+        return self.ShmVersion.unpack_from(self.mv, 0)
+
+    def read_snapshot(self):
+        """
+        Return a consistent copy of the used part of the segment, or None.
+
+        The writer updates heartbeat/shm_timestamp with every write, so they
+        act as a seqlock: the version is read before and after the copy and
+        the copy is retried if it changed in between. The daemon does not
+        document when within an update it writes them, so a copy taken
+        entirely inside an update could still see one version; to narrow
+        that window the used part is copied twice and only accepted if both
+        copies are identical. Only the header and the num_devices records
+        that are actually in use are copied.
+
+        If num_devices does not fit the mapping, the segment is remapped in
+        case it grew; if it still does not fit, the copy is cut to the
+        records that do and its num_devices patched to match.
+        """
+        mv = self.mv
+        for attempt in range(self.SNAPSHOT_RETRIES):
+            if attempt:
+                # let the writer finish its update
+                sleep(self.SNAPSHOT_RETRY_DELAY)
+            version = self.ShmVersion.unpack_from(mv, 0)
+            num_devices = mv[self.NUM_DEVICES_OFFSET]
+            if num_devices > self.capacity:
+                if self.map_segment():
+                    mv = self.mv
+                    continue
+                raw = self._clamp(mv, num_devices)
+                again = self._clamp(mv, num_devices)
+            else:
+                used = self.segment_size(num_devices)
+                raw = bytes(mv[:used])
+                again = bytes(mv[:used])
+            if raw == again and self.ShmVersion.unpack_from(mv, 0) == version:
+                return raw
+        print(f"[ShmRead] torn read after {self.SNAPSHOT_RETRIES} retries")
+        return None
+
+    def _clamp(self, mv, num_devices):
+        if self._clamped != num_devices:
+            self._clamped = num_devices
+            print(f"[ShmRead] num_devices {num_devices} exceeds the "
+                  f"{self.size} byte segment, using {self.capacity}")
+        raw = bytearray(mv[:self.segment_size(self.capacity)])
+        raw[self.NUM_DEVICES_OFFSET] = self.capacity
+        return bytes(raw)
     
-    def check_online_backend(self):        
-        with open("/tmp/online.status", 'r') as f:
-            state= f.read()        
-            return state.startswith("Online")
-        return False
+    def check_online_backend(self):
+        # False until a status is written
+        return self._online.get()
+
+    def get_databox_serial(self):
+        """Serial from DATABOX_SN_FILE, 0 until the box is provisioned."""
+        serial = self._serial_file.get()
+        return 0 if serial is None else serial
+
+    @property
+    def serial(self):
+        if self._serial is not None:
+            return self._serial
+        return self.get_databox_serial()
 
-    def get_databox_serial(self):        
-        with open("/etc/gallopiq/databox_sn", 'r') as f:
-            state = int(f.read())
-            return state 
-        return 0
+    @serial.setter
+    def serial(self, serial):
+        self._serial = serial
 
 
 
 
 
-    def encode_ble(self):
+    def build_packet_dict(self):
         # Prepare sensors list in msgpack-friendly structure
-        sensors = []
-        for i in range(self.databox['num_devices']):
-            s = self.sensors[i]
-            sensors.append({
-                "serial": s['serial'],
-                "online": bool(s['online']),
-                "measurement": bool(s['measurement']),
-                "bat_mV": int(s['bat_mV']),      # same conversion as before
-                "usb_connected": s['usb_mV'] > 4300,
-                "rssi": s['rssi'],
-                "missing_pkgs": s['n_missing_pkgs'],
-            })
+        d = self.devices
+        sensors = [
+            {
+                "serial": serial,
+                "online": bool(online),
+                "measurement": bool(measurement),
+                "bat_mV": int(bat_mV),      # same conversion as before
+                "usb_connected": usb_mV > USB_CONNECTED_MV,
+                "rssi": rssi,
+                "missing_pkgs": n_missing_pkgs,
+            }
+            for serial, online, measurement, bat_mV, usb_mV, rssi, n_missing_pkgs
+            in zip(d['serial'], d['online'], d['measurement'], d['bat_mV'],
+                   d['usb_mV'], d['rssi'], d['n_missing_pkgs'])
+        ]
 
         # Prepare top-level packet structure
         packet_dict = {
@@ -132,41 +456,111 @@ class ShmRead:
             "measure_start": list(self.databox['measure_start']),
             "num_devices": self.databox['num_devices'],
             "diskspace_percent": self.databox['diskspace_percent'],
-            "usb_connected": self.databox['usb_mV'] > 4300,
+            "usb_connected": self.databox['usb_mV'] > USB_CONNECTED_MV,
             "bat_mv": self.databox['bat_mv'],
             "online": self.databox['online'],
             "sensors": sensors,
         }
 
+        return packet_dict
+
+    def encode_ble(self, packet_dict=None, serials=None,
+                   field_mask=ALL_SENSOR_FIELDS):
+        if packet_dict is None:
+            packet_dict = self.build_packet_dict()
+        if serials is not None or field_mask != ALL_SENSOR_FIELDS:
+            packet_dict = filter_packet_dict(packet_dict, serials, field_mask)
+
         # Encode using msgpack
         packet = msgpack.packb(packet_dict, use_bin_type=True)
 
         return packet
 
     def update_data(self):
-        """Decode header + devices and update cached dicts atomically."""
-        self.raw = self.get_bytes()
+        """
+        Decode header + devices and update cached dicts atomically.
+
+        Returns True if the encoded packet changed. If nothing but the
+        heartbeat moved since the last call, decoding and encoding are
+        skipped and the previous packet object is kept.
+        """
+        with self._update_lock:
+            changed = self._update_data()
+            if self.history is not None and self.databox:
+                self.history.maybe_record(self.databox['heartbeat'][0], self.devices)
+            return changed
+
+    def _update_data(self):
+        t = perf_counter()
+        raw = self.read_snapshot()
+        t = diagnostics.since("shm_copy", t)
+        if raw is None:
+            # keep the previous consistent state
+            return False
+        self.raw = raw
+
+        online = self.check_online_backend()
+        t = diagnostics.since("check_online_backend", t)
+        content_key = (raw[self.ShmVersion.size:], online, self.serial)
+        if content_key == self._content_key:
+            hb_sec, hb_usec, ts_sec, ts_usec = self.ShmVersion.unpack_from(raw, 0)
+            with self._lock:
+                # copy, snapshots handed out by get_encoded are not mutated
+                self.databox = dict(self.databox,
+                                    heartbeat=(hb_sec, hb_usec),
+                                    shm_timestamp=(ts_sec, ts_usec))
+            return False
+        self._content_key = content_key
 
         databox = decode_header(self.raw)
-        databox['online'] = self.check_online_backend()
-        sensors = [
-            decode_device_data(self.raw, i)
-            for i in range(databox["num_devices"])
-        ]
+        databox['online'] = online
+        t = diagnostics.since("decode_header", t)
+        devices = decode_devices(self.raw, databox["num_devices"])
+        t = diagnostics.since("decode_devices", t)
 
         with self._lock:
             self.databox = databox
-            self.sensors = sensors
-            self.packet = self.encode_ble()
+            self.devices = devices
+            packet_dict = self.build_packet_dict()
+            packet = self.encode_ble(packet_dict)
+            diagnostics.since("encode_ble", t)
+            if packet == self.packet:
+                # only fields that are not sent over BLE changed
+                return False
+            self.packet = packet
+            self.packet_dict = packet_dict
+            return True
+
+    def has_data(self):
+        """True once a snapshot has been decoded, until then packet is a placeholder."""
+        return bool(self.databox)
 
     def get_state(self):
         """Return a snapshot of (databox, sensors) safely."""
         with self._lock:
-            return dict(self.databox), list(self.sensors)
+            return dict(self.databox), columns_to_sensors(self.devices)
+
+    def get_devices(self):
+        """Return the columnar device view of the last snapshot."""
+        with self._lock:
+            return self.devices
         
     def get_packet(self):
         return self.packet
 
+    def get_packet_dict(self):
+        """Return the decoded form of get_packet(), used for deltas."""
+        return self.packet_dict
+
+    def get_encoded(self):
+        """
+        Return (packet, packet_dict, (databox, devices)) of the same
+        snapshot, for encoding it in other formats later.
+        """
+        with self._lock:
+            return self.packet, self.packet_dict, (self.databox, self.devices)
+
     def close(self):
+        self.mv.release()
         self.mm.close()
         os.close(self.fd)
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+#
+# Synthetic writer for the gallopiq_shm segment.
+#
+# Creates a segment with the layout ShmRead expects and fills it with
+# simulated devices, so the GATT server and the benchmarks can run without
+# the acquisition daemon:
+#
+#   python3 shm_sim.py --devices 20 --rate 10
+#   python3 shm_sim.py --path /tmp/gallopiq_shm --devices 35
+#
+
+import os
+import time
+import mmap
+import random
+import argparse
+import tempfile
+
+from shm_read import ShmRead
+
+
+class ShmSimulator:
+    """
+    Writes a gallopiq_shm-layout segment with num_devices simulated devices.
+
+    Every write_frame() moves battery, RSSI and missing packet counters of
+    the devices a little, like the acquisition daemon does between updates.
+    The heartbeat is written before and shm_timestamp after the device
+    records, so readers can detect torn reads.
+    """
+
+    def __init__(self, path=None, num_devices=16, size=None, seed=0):
+        if size is None:
+            size = max(ShmRead.SHM_SIZE, ShmRead.segment_size(num_devices))
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix="gallopiq_shm_")
+            os.close(fd)
+        self.path = path
+        self.num_devices = num_devices
+        self.random = random.Random(seed)
+        self.measure_start = (0, 0)
+        self.running = False
+
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        os.ftruncate(self.fd, size)
+        self.mm = mmap.mmap(self.fd, size, access=mmap.ACCESS_WRITE)
+
+        self.devices = [
+            {
+                "serial": 100000 + i,
+                "online": True,
+                "measurement": False,
+                "n_missing_pkgs": 0,
+                "bat_mV": 3600 + self.random.randrange(500),
+                "usb_mV": 0,
+                "rssi": -50 - self.random.randrange(40),
+            }
+            for i in range(num_devices)
+        ]
+        self.write_frame()
+
+    def set_measuring(self, measuring):
+        self.measure_start = (int(time.time()), 0) if measuring else (0, 0)
+        for device in self.devices:
+            device["measurement"] = measuring
+
+    def step(self):
+        """Advance the simulated devices by one update."""
+        rnd = self.random
+        for device in self.devices:
+            device["bat_mV"] = max(3300, device["bat_mV"] - rnd.randrange(2))
+            device["rssi"] = max(-100, min(-30, device["rssi"] + rnd.randint(-2, 2)))
+            if rnd.random() < 0.05:
+                device["n_missing_pkgs"] += 1
+            if rnd.random() < 0.01:
+                device["online"] = not device["online"]
+
+    def write_frame(self):
+        now = time.time()
+        sec, usec = int(now), int(now % 1 * 1e6)
+        header = ShmRead.ShmHeader
+        record = ShmRead.ShmDevice
+
+        # heartbeat first, the timestamp last closes the update
+        version = ShmRead.ShmVersion
+        _, _, ts_sec, ts_usec = version.unpack_from(self.mm, 0)
+        version.pack_into(self.mm, 0, sec, usec, ts_sec, ts_usec)
+        for i, d in enumerate(self.devices):
+            record.pack_into(
+                self.mm, header.size + i * record.size,
+                d["serial"], d["online"], d["measurement"],
+                -100, 100, -100, 100, -100, 100,
+                d["n_missing_pkgs"], d["bat_mV"], d["usb_mV"], d["rssi"]
+            )
+        header.pack_into(
+            self.mm, 0,
+            sec, usec, ts_sec, ts_usec,
+            self.measure_start[0], self.measure_start[1],
+            self.num_devices, 20000, 42, 3900, 5000, 80
+        )
+        version.pack_into(self.mm, 0, sec, usec, sec, usec)
+
+    def run(self, rate_hz, duration=None):
+        """
+        Step and write at rate_hz until duration seconds passed, or until
+        stop() is called if duration is None.
+        """
+        interval = 1 / rate_hz
+        end = None if duration is None else time.monotonic() + duration
+        next_frame = time.monotonic()
+        self.running = True
+        while self.running and (end is None or next_frame < end):
+            self.step()
+            self.write_frame()
+            next_frame += interval
+            time.sleep(max(0, next_frame - time.monotonic()))
+
+    def stop(self):
+        self.running = False
+
+    def close(self, unlink=False):
+        self.mm.close()
+        os.close(self.fd)
+        if unlink:
+            os.unlink(self.path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulated gallopiq_shm writer")
+    parser.add_argument("--path", default=f"/dev/shm/{ShmRead.SHM_ADDRESS}")
+    parser.add_argument("--devices", type=int, default=16)
+    parser.add_argument("--rate", type=float, default=10.0, help="updates per second")
+    args = parser.parse_args()
+
+    sim = ShmSimulator(args.path, args.devices)
+    print(f"writing {args.devices} devices to {args.path} at {args.rate} Hz")
+    try:
+        sim.run(args.rate)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sim.close()
+
+
+if __name__ == '__main__':
+    main()
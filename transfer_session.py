@@ -0,0 +1,136 @@
+from time import perf_counter
+from collections import deque
+
+from gi.repository import GLib
+
+import diagnostics
+from framing import blob_crc
+
+
+class TransferSession:
+    """
+    Transfer state of one connected central.
+
+    Each session has its own send queue, pacer and notify timer, and
+    remembers the dataid of the transfer it is sending. The packet lists are
+    the shared, cached transfers of the characteristic, so sessions that
+    request the same snapshot at the same packet size send the same objects.
+
+    send(session, idx) is called for every fragment and returns False if the
+    link cannot take it right now. on_done(session), if given, is called
+    when the queue has been sent; it must not queue from within the call.
+    """
+
+    def __init__(self, device, pacer, send, on_done=None):
+        self.device = device
+        self.pacer = pacer
+        self.send = send
+        self.on_done = on_done
+        self.mtu = None
+        # CAP_* bits the central announced
+        self.caps = 0
+        # FORMAT_* of the last state request
+        self.format = 0
+        # (serials, field mask) of the last state request, None for all
+        self.filter = None
+        self.dataid = None
+        # refresh interval in seconds while subscribed, None otherwise
+        self.subscription = None
+        # monotonic time the next subscription push is allowed at
+        self.next_push = 0.0
+        # GLib source of a rate-limited push that is waiting
+        self.push_source_id = None
+        self.packets = []
+        self.toSend = deque()
+        self._source_id = None
+        self._last_tick = None
+
+    def queue(self, packets):
+        """Replace whatever is pending with a full transfer of packets."""
+        self.packets = packets
+        # byte 2 of the header packet is the dataid of the transfer
+        self.dataid = packets[0][2]
+        self.toSend = deque(range(len(packets)))
+        self.start()
+
+    def base(self):
+        """(dataid, blob CRC) of the last transfer, None before the first."""
+        if not self.packets:
+            return None
+        return self.dataid, blob_crc(self.packets[0])
+
+    def requeue(self, indices):
+        """Queue the given fragments of the current transfer again."""
+        queued = set(self.toSend)
+        for idx in indices:
+            if idx < len(self.packets) and idx not in queued:
+                self.toSend.append(idx)
+                queued.add(idx)
+        if self.toSend:
+            self.start()
+
+    def discard(self, idx):
+        """Drop fragment idx, it reached this central through another session."""
+        try:
+            self.toSend.remove(idx)
+        except ValueError:
+            pass
+
+    def is_sending(self):
+        return self._source_id is not None
+
+    def start(self):
+        if self._source_id is not None:
+            return
+        # send one burst immediately, then every pacer interval
+        if self._tick():
+            self._source_id = GLib.timeout_add(self.pacer.interval_ms,
+                                               self._on_timer)
+
+    def stop(self):
+        if self._source_id is not None:
+            GLib.source_remove(self._source_id)
+            self._source_id = None
+        self._last_tick = None
+        self.toSend.clear()
+
+    def _on_timer(self):
+        # timer jitter: how far apart the ticks of a running transfer really are
+        now = perf_counter()
+        if self._last_tick is not None:
+            diagnostics.record("notify_interval", now - self._last_tick)
+        self._last_tick = now
+        if self._tick():
+            return True  # keep the timeout running
+        self._source_id = None
+        self._last_tick = None
+        return False  # stop the timeout
+
+    def _tick(self):
+        """Send as many fragments as the pacer allows, False when done."""
+        sent = 0
+        blocked = False
+        for _ in range(self.pacer.fragments_per_tick()):
+            if not self.toSend:
+                break
+            idx = self.toSend.popleft()
+            if not self.send(self, idx):
+                # link is full, retry after backing off
+                self.toSend.appendleft(idx)
+                blocked = True
+                break
+            sent += 1
+        self.pacer.on_tick(sent, blocked)
+
+        if self.toSend:
+            return True
+        # achieved throughput as seconds per fragment ("fragment_period",
+        # fragments/s = 1e6 / us) in the stats socket and the diagnostics
+        # characteristic; not logged, subscriptions finish a transfer up to
+        # 25 times a second
+        rate = self.pacer.on_transfer_done()
+        if rate:
+            diagnostics.record("fragment_period", 1 / rate)
+        if self.on_done is not None:
+            self.on_done(self)
+        return False
@@ -0,0 +1,29 @@
+import dbus
+import msgpack
+
+import diagnostics
+from characteristic import Characteristic
+from definitions import *
+
+
+class DataboxDiagnosticsCharacteristic(Characteristic):
+    """
+    Read-only msgpack map of the pipeline timing histograms:
+    {stage: [count, p50_us, p99_us, max_us]}
+    """
+
+    def __init__(self, bus, index, uuid, service):
+        Characteristic.__init__(self, bus, index, uuid,
+                                ['read'], service)
+        self.value = b""
+
+    @dbus.service.method(GATT_CHRC_IFACE,
+                         in_signature='a{sv}',
+                         out_signature='ay')
+    def ReadValue(self, options):
+        offset = int(options.get('offset', 0))
+        # BlueZ splits a long read into several calls with growing offsets,
+        # they must all see the same snapshot
+        if offset == 0:
+            self.value = msgpack.packb(diagnostics.compact())
+        return dbus.ByteArray(self.value[offset:])
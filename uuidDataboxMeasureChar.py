@@ -1,52 +1,74 @@
 import dbus
-import time
 import struct
-import threading
-import socket
+
+from gi.repository import GLib
 
 from characteristic import Characteristic
+from control_client import ControlClient
 from definitions import *
 
 
-def send_measure_stop(host='127.0.0.1', port=4242) -> str:
-    with socket.create_connection((host, port)) as sock:
-        sock.sendall(b'measure_stop\n')
-        response = sock.recv(4096)  # Adjust size as needed
-        return response.decode('utf-8')
-
-def send_measure_start(host='127.0.0.1', port=4242) -> str:
-    with socket.create_connection((host, port)) as sock:
-        sock.sendall(b'measure_start\n')
-        response = sock.recv(4096)  # Adjust size as needed
-        return response.decode('utf-8')
-    
-
 class DataboxMeasureCharacteristic(Characteristic):
 
-    
+
     TIME_THRESHOLD = 120  # seconds (2 minutes)
-    
-    def __init__(self, bus, index, uuid, service):
+
+    CMD_MEASURE_START = b"\xff\xff\xff\x01"
+    CMD_MEASURE_STOP = b"\xff\xff\xff\x00"
+    COMMANDS = {
+        CMD_MEASURE_START: "measure_start",
+        CMD_MEASURE_STOP: "measure_stop",
+    }
+    CODES = {name: cmd[3] for cmd, name in COMMANDS.items()}
+
+    # Result of the last command, read or notified:
+    #   uint8 last byte of the command (0x01 start, 0x00 stop),
+    #   uint8 ControlClient.RESULT_*, uint16 latency in ms,
+    #   then the daemon's response line, cut to fit a 23 byte ATT MTU
+    Status = struct.Struct("<BBH")
+    STATUS_TEXT_MAX = 20 - Status.size
+
+    def __init__(self, bus, index, uuid, service, control=None):
         Characteristic.__init__(self, bus, index, uuid,
-                                ['read', 'write'], service)
+                                ['read', 'write', 'notify'], service)
+        self.control = control or ControlClient()
+        self.notifying = False
+        self.status = b""
 
     @dbus.service.method(GATT_CHRC_IFACE,
                          in_signature='a{sv}',
                          out_signature='ay')
-    
-    def ReadValue(self, options):
-        now = int(time.time())
-        print(f"[TimeCharacteristic] ReadValue → {now}")
 
-        # pack time_t (64-bit LE)
-        data = struct.pack("<Q", now)
-        return dbus.ByteArray(data)
+    def ReadValue(self, options):
+        return dbus.ByteArray(self.status)
 
     @dbus.service.method(GATT_CHRC_IFACE,in_signature='aya{sv}')
     def WriteValue(self, value, options):
-        if bytes(value) == b"\xff\xff\xff\x01":
-            threading.Thread(target=send_measure_start, daemon=True).start()
-        if bytes(value) == b"\xff\xff\xff\x00":
-            threading.Thread(target=send_measure_stop, daemon=True).start()
+        value = bytes(value)
+        command = self.COMMANDS.get(value)
+        if command is not None:
+            self.control.send(command, self._on_result)
         return
 
+    @dbus.service.method(GATT_CHRC_IFACE)
+    def StartNotify(self):
+        self.notifying = True
+
+    @dbus.service.method(GATT_CHRC_IFACE)
+    def StopNotify(self):
+        self.notifying = False
+
+    def _on_result(self, command, result, response, latency):
+        # called on the control client thread
+        print(f"[Measure] {command}: result {result}, {latency * 1e3:.1f} ms, {response!r}")
+        status = self.Status.pack(self.CODES[command], result,
+                                  min(0xFFFF, int(latency * 1000)))
+        status += response.encode('utf-8')[:self.STATUS_TEXT_MAX]
+        GLib.idle_add(self._publish_status, status)
+
+    def _publish_status(self, status):
+        self.status = status
+        if self.notifying:
+            self.PropertiesChanged(GATT_CHRC_IFACE,
+                                   {'Value': dbus.ByteArray(status)}, [])
+        return False
@@ -1,127 +1,647 @@
 import dbus
+import dbus.types
 
 
-import zlib
+import copy
 import struct
+import socket
 import threading
-from collections import deque
-from shm_read import ShmRead
+from time import perf_counter, monotonic
+from collections import OrderedDict
+from shm_read import ShmRead, encode_delta, encode_columnar, filter_packet_dict
+from shm_read import ALL_SENSOR_FIELDS
+from compression import compress
+import framing
+from framing import encode_fragments, blob_crc
+from gi.repository import GLib
 from characteristic import NotifyCharacteristic
+from pacing import Pacer
+from shm_poller import ShmPoller
+from connections import ConnectionTracker
+from transfer_session import TransferSession
+import diagnostics
 from definitions import *
 
 
 class DataboxStateCharacteristic(NotifyCharacteristic):
-    def __init__(self, bus, index, uuid, service):
+    # number of previous states kept as delta baselines
+    DELTA_HISTORY = 8
+
+    # payload size used when BlueZ did not tell us the ATT MTU
+    DEFAULT_PACKET_SIZE = 100
+    # pLen + dataid + section id + paket id + CRC
+    PACKET_OVERHEAD = framing.PACKET_OVERHEAD
+    # opcode + handle of a Handle Value Notification
+    ATT_NOTIFY_HEADER = 3
+    ATT_MIN_MTU = 23
+    # largest attribute value is 512 bytes
+    ATT_MAX_MTU = 512 + ATT_NOTIFY_HEADER
+
+    # default pacing: NOTIFY_BURST fragments every NOTIFY_INTERVAL_MS
+    NOTIFY_INTERVAL_MS = 40
+    NOTIFY_BURST = 4
+
+    # optionally followed by uint8 FORMAT_* of the state blob, which can be
+    # followed by a filter for this and all later transfers to the client:
+    # uint8 field mask over shm_read.SENSOR_FIELDS and zero or more uint32
+    # sensor serials (none: all sensors). Without a filter everything is
+    # sent. Filters apply to FORMAT_MSGPACK full and delta transfers.
+    # While several centrals are connected, format and filter only apply
+    # if all of them asked for the same, see get_session_format.
+    CMD_STATE = b"\xff\xff\xff\xff"
+    SerialList = struct.Struct("<I")
+    # msgpack map built by ShmRead.encode_ble
+    FORMAT_MSGPACK = 0
+    # shm_read.encode_columnar, full transfers only
+    FORMAT_COLUMNAR = 1
+    SUPPORTED_FORMATS = (FORMAT_MSGPACK, FORMAT_COLUMNAR)
+    # followed by uint8 dataid and uint32 blob CRC (from the header
+    # fragment) of the last transfer the client fully received. dataids
+    # wrap and restart with the process, so the CRC must match a transfer
+    # sent for that state, otherwise the full state is sent. A request
+    # without the CRC always gets the full state.
+    CMD_STATE_DELTA = b"\xff\xff\xff\xfe"
+    DeltaBase = struct.Struct("<BI")
+    # followed by uint8 dataid, uint32 blob CRC of the transfer, uint8 mode
+    # and the missing fragments:
+    #   NACK_LIST:   (uint16 section id, uint8 paket id) per missing fragment
+    #   NACK_BITMAP: bit n (LSB first) set for missing fragment number
+    #                section id * 256 + paket id, the header being number 0
+    CMD_NACK = b"\xff\xff\xff\xfd"
+    NACK_LIST = 0
+    NACK_BITMAP = 1
+    NackHead = struct.Struct("<BIB")
+    NackEntry = struct.Struct("<HB")
+
+    # followed by uint8 CAP_* bits the client supports. Once a client has
+    # announced capabilities, its header packets carry a trailing uint8 of
+    # FLAG_* bits describing the transfer; other clients get the old header.
+    CMD_CAPS = b"\xff\xff\xff\xfc"
+    # blob is zlib-compressed with compression.ZDICT as preset dictionary,
+    # the CRC in the header covers the compressed blob
+    CAP_ZLIB = 0x01
+    FLAG_ZLIB = 0x01
+    SUPPORTED_CAPS = CAP_ZLIB
+
+    # followed by uint8 refresh rate in Hz, 0 ends the subscription. While
+    # subscribed, every new state is pushed without a request, at most at
+    # that rate: full first, then deltas against the previous push. States
+    # that arrive while a push is still being sent are skipped, the latest
+    # one follows when it is done.
+    CMD_SUBSCRIBE = b"\xff\xff\xff\xfb"
+    SUBSCRIBE_MAX_RATE = 25
+
+    # followed by uint32 start and uint32 end unix time and optionally a
+    # uint16 step (send every step-th sample). The samples of shm.history
+    # in that range are sent as one transfer under HISTORY_DATAID, see
+    # history.HistoryRing.encode for the blob. Ignored without a history.
+    CMD_HISTORY = b"\xff\xff\xff\xfa"
+    HistoryRange = struct.Struct("<II")
+    HistoryStep = struct.Struct("<H")
+    # first of the dataids 251-255 that are never used for states
+    HISTORY_DATAID = 251
+
+    # how often the background poller checks the shm heartbeat
+    POLL_INTERVAL_MS = 100
+
+    def __init__(self, bus, index, uuid, service, shm=None):
         super().__init__(bus, index, uuid, service)
-        self.shm = ShmRead()
-        self.toSend=deque()
+        self.shm = shm or ShmRead()
+        # guards dataid, blob, history and transfers against the poller
+        self._state_lock = threading.Lock()
         self.dataid=0
-        self.packets=[]
-        self.set_interval(40)
+        # blob of the current state (dataid)
+        self.blob=None
+        # (databox, devices) the current state was encoded from
+        self.snapshot=None
+        # dataid -> (packet dict, {blob CRC: (format, filter)}) of recent
+        # states, the CRCs are those of the full and delta transfers built
+        # for that state
+        self.history=OrderedDict()
+        # (baseline dataid or None, packet size, caps, format, filter) ->
+        # packets of the current state
+        self.transfers={}
+        # device object path -> TransferSession of that central
+        self.sessions={}
+        # our end of the socket handed to BlueZ by AcquireNotify
+        self.notify_socket=None
+        self._notify_socket_watch=None
+        self.set_pacer(Pacer(self.NOTIFY_INTERVAL_MS, self.NOTIFY_BURST))
+
+        history = self.shm.history
+        self.poller = ShmPoller(
+            self.shm, self._precompute, self.POLL_INTERVAL_MS,
+            None if history is None else history.resolution_s * 1000)
+        self.connections = ConnectionTracker(bus)
+        self.connections.add_listener(self._on_connection_changed)
+        self.poller.start()
     
-    def _async_update(self):
+    def _async_update(self, session, base=None):
         self.shm.update_data()
-        self.set_data(self.shm.get_packet())
-        self.StartNotify()
+        if not self.shm.has_data():
+            print("[State] no shm snapshot yet, state request dropped")
+            return
+        self.update_state(*self.shm.get_encoded())
+        GLib.idle_add(self._queue_transfer, session,
+                      self.get_session_transfer(session, base))
+
+    def _async_history(self, session, start, end, step):
+        blob = self.shm.history.encode(start, end, step)
+        packets = self.frame(blob, self.HISTORY_DATAID,
+                             self.get_packet_size(session), session.caps)
+        print(f"[State] history {start}..{end}: {len(blob)} bytes, "
+              f"{len(packets)} fragments")
+        GLib.idle_add(self._queue_transfer, session, packets)
+
+    def request_history(self, session, value):
+        if self.shm.history is None or len(value) < self.HistoryRange.size:
+            return
+        start, end = self.HistoryRange.unpack_from(value)
+        step = 1
+        if len(value) >= self.HistoryRange.size + self.HistoryStep.size:
+            step, = self.HistoryStep.unpack_from(value, self.HistoryRange.size)
+        # encoding a deep history takes a while, keep it off the main loop
+        threading.Thread(target=self._async_history,
+                         args=(session, start, end, step), daemon=True).start()
+
+    def _queue_transfer(self, session, packets):
+        if self.sessions.get(session.device) is session:
+            session.queue(packets)
+        return False
+
+    def _precompute(self):
+        """Poller callback: build the full transfer for every format in use."""
+        self.update_state(*self.shm.get_encoded())
+        for packet_size, caps, fmt, filt in self.formats_in_use():
+            self.get_transfer(None, packet_size, caps, fmt, filt)
+        GLib.idle_add(self._push_subscriptions)
+
+    def _push_subscriptions(self):
+        now = monotonic()
+        for session in list(self.sessions.values()):
+            if session.subscription is not None:
+                self._push(session, now)
+        return False
+
+    def _push(self, session, now=None):
+        """Send the current state to a subscribed session if it is due."""
+        if session.subscription is None or self.blob is None:
+            return False
+        if session.is_sending():
+            # link is behind, _on_transfer_done pushes the latest state
+            return False
+        if session.dataid == self.dataid and self.has_state(session.base()):
+            # already has the current state
+            return False
+        if now is None:
+            now = monotonic()
+        wait = session.next_push - now
+        if wait > 0:
+            if session.push_source_id is None:
+                session.push_source_id = GLib.timeout_add(
+                    max(1, int(wait * 1000)), self._on_push_timer, session)
+            return False
+        session.next_push = now + session.subscription
+        # deltas against the previous push, get_transfer falls back to a
+        # full transfer if that state is no longer in the history
+        session.queue(self.get_session_transfer(session, session.base()))
+        return False
+
+    def _on_push_timer(self, session):
+        session.push_source_id = None
+        return self._push(session)
+
+    def _on_transfer_done(self, session):
+        if session.subscription is not None:
+            GLib.idle_add(self._push, session)
+
+    def subscribe(self, session, rate):
+        """Push new states to session at up to rate Hz, rate 0 unsubscribes."""
+        self.unsubscribe(session)
+        if rate == 0:
+            return
+        session.subscription = 1 / min(rate, self.SUBSCRIBE_MAX_RATE)
+        session.next_push = 0.0
+        self._update_poll_interval()
+        self.poller.resume()
+        # start with a full state, whatever the session had before
+        session.dataid = None
+        self._push(session)
+
+    def unsubscribe(self, session):
+        if session.push_source_id is not None:
+            GLib.source_remove(session.push_source_id)
+            session.push_source_id = None
+        if session.subscription is not None:
+            session.subscription = None
+            self._update_poll_interval()
+
+    def _update_poll_interval(self):
+        """Poll shm at least as often as the fastest subscription wants."""
+        interval_ms = self.POLL_INTERVAL_MS
+        for session in list(self.sessions.values()):
+            if session.subscription is not None:
+                interval_ms = min(interval_ms, int(session.subscription * 1000))
+        self.poller.set_interval(interval_ms)
+
+    def _on_connection_changed(self, device, connected):
+        if not connected:
+            session = self.sessions.pop(device, None)
+            if session is not None:
+                self.unsubscribe(session)
+                session.stop()
+        if self.connections.connected:
+            self.poller.resume()
+        else:
+            self.poller.pause()
+
+    def request_state(self, session, base=None):
+        """
+        Start a state transfer to session. If the poller has an up-to-date
+        transfer ready, notifying starts straight away, otherwise shm is
+        read first in a worker thread.
+        """
+        if self.poller.is_fresh():
+            session.queue(self.get_session_transfer(session, base))
+        else:
+            threading.Thread(target=self._async_update, args=(session, base),
+                             daemon=True).start()
+
+    def get_session(self, options):
+        """
+        Return the session of the central that sent options, creating it if
+        needed, and remember the MTU BlueZ reports for it. Requests without
+        a device option (old BlueZ) share the session of device None.
+        """
+        device = options.get('device')
+        if device is not None:
+            device = str(device)
+            self.connections.seen(device)
+        session = self.sessions.get(device)
+        if session is None:
+            session = TransferSession(device, copy.copy(self.pacer),
+                                      self._send_fragment,
+                                      self._on_transfer_done)
+            self.sessions[device] = session
+        if 'mtu' in options:
+            session.mtu = int(options['mtu'])
+        return session
+
+    def formats_in_use(self):
+        """
+        (packet size, capabilities, format, filter) of all sessions plus
+        the default.
+        """
+        formats = {self.get_session_format(session)
+                   for session in list(self.sessions.values())}
+        formats.add((self.DEFAULT_PACKET_SIZE, 0, self.FORMAT_MSGPACK, None))
+        return formats
+
+    def get_session_format(self, session):
+        """
+        (packet size, capabilities, format, filter) of the transfers for
+        session.
+
+        BlueZ notifies every subscribed central of every fragment, and all
+        variants of a state share its dataid, so fragments of different
+        packet lists would mix in the other centrals' reassembly. While
+        several sessions exist they therefore all get the same variant:
+        the smallest packet size, the capabilities all of them announced,
+        and the format and filter they agree on, msgpack without a filter
+        otherwise. _send_fragment then sends each fragment once for all.
+        """
+        sessions = list(self.sessions.values())
+        if len(sessions) <= 1:
+            return (self.get_packet_size(session), session.caps, session.format,
+                    session.filter)
+        caps = self.SUPPORTED_CAPS
+        for other in sessions:
+            caps &= other.caps
+        formats = {other.format for other in sessions}
+        filters = {other.filter for other in sessions}
+        return (min(self.get_packet_size(other) for other in sessions), caps,
+                formats.pop() if len(formats) == 1 else self.FORMAT_MSGPACK,
+                filters.pop() if len(filters) == 1 else None)
+
+    def get_session_transfer(self, session, base=None):
+        if len(self.sessions) > 1:
+            # deltas depend on each central's baseline and cannot be shared
+            base = None
+        return self.get_transfer(base, *self.get_session_format(session))
+
+    def parse_filter(self, value):
+        """
+        Return the (serials, field mask) filter of a state request after
+        the format byte, None if it selects everything.
+        """
+        field_mask = value[0] & ALL_SENSOR_FIELDS
+        usable = len(value) - 1 - (len(value) - 1) % self.SerialList.size
+        serials = None
+        if usable:
+            serials = frozenset(
+                serial for serial, in self.SerialList.iter_unpack(value[1:1 + usable]))
+        if serials is None and field_mask == ALL_SENSOR_FIELDS:
+            return None
+        return serials, field_mask
+
+    def get_packet_size(self, session=None):
+        """Largest fragment payload that fits one notification to session."""
+        mtu = None if session is None else session.mtu
+        if mtu is None:
+            return self.DEFAULT_PACKET_SIZE
+        mtu = min(mtu, self.ATT_MAX_MTU)
+        return max(1, mtu - self.ATT_NOTIFY_HEADER - self.PACKET_OVERHEAD)
 
     @dbus.service.method(GATT_CHRC_IFACE,in_signature='aya{sv}')
     def WriteValue(self, value, options):
-        if bytes(value) == b"\xff\xff\xff\xff":
-            threading.Thread(target=self._async_update, daemon=True).start()
+        session = self.get_session(options)
+        value = bytes(value)
+        if value == self.CMD_STATE:
+            # a plain request always means the full msgpack state
+            session.format = self.FORMAT_MSGPACK
+            session.filter = None
+            self.request_state(session)
+        elif len(value) >= 5 and value.startswith(self.CMD_STATE):
+            if value[4] in self.SUPPORTED_FORMATS:
+                session.format = value[4]
+                session.filter = self.parse_filter(value[5:]) if len(value) > 5 else None
+                self.request_state(session)
+        elif len(value) >= 5 and value.startswith(self.CMD_STATE_DELTA):
+            base = None
+            if len(value) >= 4 + self.DeltaBase.size:
+                base = self.DeltaBase.unpack_from(value, 4)
+            self.request_state(session, base)
+        elif len(value) >= 4 + self.NackHead.size and value.startswith(self.CMD_NACK):
+            dataid, crc, mode = self.NackHead.unpack_from(value, 4)
+            if not self.resend(session, dataid, crc, mode,
+                               value[4 + self.NackHead.size:]):
+                # fragments of that dataid are gone, send the current state
+                self.request_state(session)
+        elif len(value) == 5 and value.startswith(self.CMD_CAPS):
+            session.caps = value[4] & self.SUPPORTED_CAPS
+        elif len(value) == 5 and value.startswith(self.CMD_SUBSCRIBE):
+            self.subscribe(session, value[4])
+        elif len(value) >= 12 and value.startswith(self.CMD_HISTORY):
+            self.request_history(session, value[4:])
         return
 
-    
-    def set_data(self,data):
-        self.split_into_packets(data)
-    
+    def parse_nack(self, mode, payload):
+        """Return the fragment numbers listed in a NACK payload."""
+        if mode == self.NACK_LIST:
+            usable = len(payload) - len(payload) % self.NackEntry.size
+            return [
+                self.get_paket_nr(section_id, packet_id)
+                for section_id, packet_id
+                in self.NackEntry.iter_unpack(payload[:usable])
+            ]
+        if mode == self.NACK_BITMAP:
+            return [
+                byte_idx * 8 + bit
+                for byte_idx, byte in enumerate(payload) if byte
+                for bit in range(8) if byte & (1 << bit)
+            ]
+        return []
+
+    def resend(self, session, dataid, crc, mode, payload):
+        """
+        Queue the fragments a client reported missing for the transfer of
+        dataid and blob CRC crc again. Returns False if the packets of that
+        transfer are no longer cached.
+        """
+        if not session.packets or session.dataid != dataid \
+                or blob_crc(session.packets[0]) != crc:
+            return False
+        session.requeue(self.parse_nack(mode, payload))
+        return True
+
+
+    def update_state(self, data, packet_dict=None, snapshot=None):
+        """
+        Make data the current state. A new dataid is only assigned when data
+        differs from the current state. Returns True if it did.
+        snapshot is the (databox, devices) pair data was encoded from.
+        """
+        with self._state_lock:
+            if data is self.blob or data == self.blob:
+                return False
+            self.blob = data
+            self.snapshot = snapshot
+            self.dataid = self.dataid+1
+            if(self.dataid>250):
+                self.dataid=0
+                # reserve 251-255
+            self.history.pop(self.dataid, None)
+            self.history[self.dataid] = (packet_dict, {})
+            while len(self.history) > self.DELTA_HISTORY:
+                self.history.popitem(last=False)
+            self.transfers = {}
+            return True
+
+    def get_transfer(self, base=None, packet_size=DEFAULT_PACKET_SIZE, caps=0,
+                     fmt=FORMAT_MSGPACK, filt=None):
+        """
+        Return the packets of the current state in format fmt. If base is
+        the (dataid, blob CRC) of a transfer sent for a state that is still
+        in the history, with the same filter, only the changes since that
+        state are sent (msgpack only), otherwise the full blob. caps are the
+        capabilities the client announced; with CAP_ZLIB the blob is
+        compressed if that makes it smaller. filt is a (serials, field
+        mask) pair from parse_filter. Fragmented transfers are cached per
+        baseline, packet size, capabilities, format and filter until the
+        state changes.
+        """
+        with self._state_lock:
+            current, crcs = self.history.get(self.dataid, (None, None))
+            if current is None or fmt != self.FORMAT_MSGPACK \
+                    or not self.is_baseline(base, filt):
+                base = None
+            elif base is not None:
+                base = base[0]
+            if fmt == self.FORMAT_COLUMNAR and self.snapshot is None:
+                fmt = self.FORMAT_MSGPACK
+            if fmt != self.FORMAT_MSGPACK or current is None:
+                filt = None
+
+            key = (base, packet_size, caps, fmt, filt)
+            packets = self.transfers.get(key)
+            if packets is None:
+                if fmt == self.FORMAT_COLUMNAR:
+                    blob = encode_columnar(*self.snapshot, self.shm.serial)
+                elif base is None:
+                    if filt is None:
+                        blob = self.blob
+                    else:
+                        blob = self.shm.encode_ble(current, *filt)
+                elif filt is None:
+                    blob = encode_delta(self.history[base][0], current, base)
+                else:
+                    blob = encode_delta(filter_packet_dict(self.history[base][0], *filt),
+                                        filter_packet_dict(current, *filt), base)
+                t = perf_counter()
+                packets = self.frame(blob, self.dataid, packet_size, caps)
+                diagnostics.since("fragment", t)
+                self.transfers[key] = packets
+                if crcs is not None:
+                    # identifies this state to a client holding the transfer
+                    crcs[blob_crc(packets[0])] = (fmt, filt)
+            return packets
+
+    def has_state(self, base):
+        """
+        True if base is the (dataid, blob CRC) of a transfer built for a
+        state that is still in the history.
+        """
+        return self.get_variant(base) is not None
+
+    def get_variant(self, base):
+        """(format, filter) of the transfer base, None if unknown."""
+        if base is None:
+            return None
+        dataid, crc = base
+        entry = self.history.get(dataid)
+        if entry is None:
+            return None
+        return entry[1].get(crc)
+
+    def is_baseline(self, base, filt):
+        """
+        True if base names a msgpack transfer with filter filt of a state
+        still in the history, so deltas against that state can be sent.
+        """
+        return self.get_variant(base) == (self.FORMAT_MSGPACK, filt)
+
+    def frame(self, blob, dataid, packet_size, caps=0):
+        """
+        Fragment blob under dataid for a client with capabilities caps,
+        compressing it first if the client supports that and it helps.
+        """
+        flags = None
+        if caps:
+            # client understands the extended header
+            flags = 0
+            if caps & self.CAP_ZLIB:
+                compressed = compress(blob)
+                if len(compressed) < len(blob):
+                    blob = compressed
+                    flags |= self.FLAG_ZLIB
+        return encode_fragments(blob, dataid, packet_size, flags)
+
     def get_paket_nr(self,section_id,packet_id):
         return section_id*256+packet_id
     
-    def split_into_packets(self,data_blob, packet_size=100):
-        self.packets = []
-        self.dataid = self.dataid+1
-        if(self.dataid>250):
-            self.dataid=0
-            # reserve 251-255
-        
-        # packet: 8 byte meta, then data
-        # 0-3 uint32: CRC
-        #  4  uint8: dataid
-        # 5-6 uint16: section id
-        # 7  uint8: paketid
-        # 8 .... data
-        section_id = 0
-        paket_id = 1
-        
-        last_section = 0
-        last_paket = 1
-        
-        crc_full = zlib.crc32(data_blob) & 0xFFFFFFFF        
-        
-        for i in range(0, len(data_blob), packet_size):
-            chunk = bytearray()
-            chunk += struct.pack('<B', self.dataid) # uint8
-            chunk += struct.pack('<H', section_id) # uint16
-            chunk += struct.pack('<B', paket_id) # uint8
-            chunk += data_blob[i:i + packet_size]
-            
-            # Compute CRC32 of this chunk
-            crc = zlib.crc32(chunk) & 0xFFFFFFFF            
-            # Append CRC to the chunk (4 bytes)
-            pLen =  2 + len(chunk) + 4
-            packet =struct.pack('<H', pLen) +  chunk + crc.to_bytes(4, byteorder="little")
-                    
-            self.packets.append(packet)
-            
-            last_section = section_id
-            last_paket = paket_id
-            
-            paket_id = paket_id+1
-            if(paket_id>255):
-                section_id = section_id+1
-                paket_id =0
-        
-        chunk = bytearray()        
-        chunk += struct.pack('<B', self.dataid) # uint8
-        chunk += struct.pack('<H', 0) # uint16 section id 0
-        chunk += struct.pack('<B', 0) # uint16 paket id 0
-        chunk += struct.pack('<H', last_section) # uint16 last section
-        chunk += struct.pack('<B', last_paket) # uint16 last paket
-        chunk += crc_full.to_bytes(4, byteorder="little")
-        crc = zlib.crc32(chunk) & 0xFFFFFFFF        
-        pLen =  2 + len(chunk) + 4
-        packet =struct.pack('<H', pLen) +  chunk + crc.to_bytes(4, byteorder="little")
-        
-        self.packets.insert(0, packet)        
-        
-        
-        self.toSend = deque(range(len(self.packets)))
-        # print(f"got {len(self.packets)} packets")
-    
-    
-    def get_next_paket_to_send(self):
-        if not self.toSend or len(self.toSend)<1:            
-            return None
-                
-        idx = self.toSend.popleft()   # O(1)
-        return self.packets[idx], idx
-    
-    
-    def _notify(self):
+    def set_pacer(self, pacer):
         """
-        Called periodically by GLib.timeout_add to push notifications.
+        Use pacer to decide how many fragments go out per tick. Every new
+        session gets its own copy.
+        """
+        self.pacer = pacer
+        self.set_interval(pacer.interval_ms)
+
+    @dbus.service.method(GATT_CHRC_IFACE)
+    def StartNotify(self):
+        # transfers are driven by the per-session timers
+        self.notifying = True
+
+    @dbus.service.method(GATT_CHRC_IFACE)
+    def StopNotify(self):
+        self.stop_notifying()
+
+    def stop_notifying(self):
+        # last subscriber is gone, nobody receives the pending fragments
+        self.notifying = False
+        for session in list(self.sessions.values()):
+            self.unsubscribe(session)
+            session.stop()
+
+    def _send_fragment(self, session, idx):
         """
-        result = self.get_next_paket_to_send()
-        if result is None:
-            # nothing to send anymore: stop notifications
-            self.StopNotify()
-            return False  # stop the timeout
+        Send fragment idx of session's transfer.
+
+        BlueZ delivers every notification to all subscribed centrals, so a
+        fragment that went out for one session also reached every other
+        session sending the same packet list; it is dropped from their
+        queues instead of being sent again. With several sessions all state
+        transfers share one packet list, see get_session_format.
+        """
+        packets = session.packets
+        if not self.send_packet(packets[idx]):
+            return False
+        for other in list(self.sessions.values()):
+            if other is not session and other.packets is packets:
+                other.discard(idx)
+        return True
+
+    def send_packet(self, paket):
+        """
+        Send one fragment to the central. Uses the socket handed out by
+        AcquireNotify if there is one, PropertiesChanged otherwise.
+        Returns False if the socket cannot take the fragment right now.
+        """
+        t = perf_counter()
+        sock = self.notify_socket
+        if sock is not None:
+            try:
+                sock.send(paket)
+                diagnostics.since("notify_socket", t)
+                return True
+            except BlockingIOError:
+                return False
+            except OSError as e:
+                print(f"[State] notify socket failed: {e}")
+                self.release_notify_socket()
 
-        paket, idx = result
-        # print(f"send packet {idx}")
         self.PropertiesChanged(
             GATT_CHRC_IFACE,
             {'Value': dbus.ByteArray(paket)},
             []
         )
-        return True  # keep the timeout running
+        diagnostics.since("notify_signal", t)
+        return True
+
+    def build_properties(self):
+        props = super().build_properties()
+        # presence of NotifyAcquired tells BlueZ that AcquireNotify is supported
+        props[GATT_CHRC_IFACE]['NotifyAcquired'] = dbus.Boolean(
+            self.notify_socket is not None)
+        return props
+
+    def attach_notify_socket(self, sock):
+        """Send notifications through sock (our end of the AcquireNotify pair)."""
+        self.release_notify_socket()
+        sock.setblocking(False)
+        self.notify_socket = sock
+        self._notify_socket_watch = GLib.io_add_watch(
+            sock.fileno(), GLib.PRIORITY_DEFAULT,
+            GLib.IO_HUP | GLib.IO_ERR, self._on_notify_socket_hup)
+        self.set_property('NotifyAcquired', dbus.Boolean(True))
+
+    def release_notify_socket(self):
+        """Close the AcquireNotify socket and fall back to PropertiesChanged."""
+        if self.notify_socket is None:
+            return
+        if self._notify_socket_watch is not None:
+            GLib.source_remove(self._notify_socket_watch)
+            self._notify_socket_watch = None
+        self.notify_socket.close()
+        self.notify_socket = None
+        self.set_property('NotifyAcquired', dbus.Boolean(False))
+
+    def _on_notify_socket_hup(self, fd, condition):
+        # BlueZ closes its end when the central unsubscribes or disconnects,
+        # it does not call StopNotify for an acquired notification
+        self._notify_socket_watch = None
+        self.release_notify_socket()
+        self.stop_notifying()
+        return False
+
+    @dbus.service.method(GATT_CHRC_IFACE,
+                         in_signature='a{sv}',
+                         out_signature='hq')
+    def AcquireNotify(self, options):
+        session = self.get_session(options)
+        mtu = session.mtu or self.ATT_MIN_MTU
+        ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.attach_notify_socket(ours)
+        fd = dbus.types.UnixFd(theirs)
+        theirs.close()
+        return fd, dbus.UInt16(mtu)
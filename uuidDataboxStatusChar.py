@@ -0,0 +1,47 @@
+import dbus
+
+from characteristic import Characteristic
+from shm_read import ShmRead, encode_status, STATUS_NO_DATAID
+from definitions import *
+
+
+class DataboxStatusCharacteristic(Characteristic):
+    """
+    Read-only status of a few bytes (see shm_read.encode_status) for cheap
+    polling; the full state is only needed when the dataid in it changes.
+    The value is rebuilt at most once per shm heartbeat. Above 35 devices
+    it no longer fits one read at the default MTU, reads with an offset
+    return the rest.
+    """
+
+    def __init__(self, bus, index, uuid, service, shm=None, state=None):
+        Characteristic.__init__(self, bus, index, uuid,
+                                ['read'], service)
+        self.shm = shm or ShmRead()
+        # state characteristic whose dataid is reported, optional
+        self.state = state
+        self._key = None
+        self.value = b""
+
+    def get_dataid(self):
+        if self.state is None or self.state.blob is None:
+            return STATUS_NO_DATAID
+        return self.state.dataid
+
+    def get_status(self):
+        dataid = self.get_dataid()
+        key = (self.shm.get_version(), dataid)
+        if key != self._key:
+            raw = self.shm.read_snapshot()
+            if raw is None:
+                # torn read, keep the previous value
+                return self.value
+            self.value = encode_status(raw, self.shm.check_online_backend(), dataid)
+            self._key = key
+        return self.value
+
+    @dbus.service.method(GATT_CHRC_IFACE,
+                         in_signature='a{sv}',
+                         out_signature='ay')
+    def ReadValue(self, options):
+        return dbus.ByteArray(self.get_status()[int(options.get('offset', 0)):])
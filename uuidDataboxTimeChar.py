@@ -1,6 +1,7 @@
 import dbus
 import time
 import struct
+import threading
 import subprocess
 
 
@@ -8,19 +9,75 @@ from characteristic import Characteristic
 from definitions import *
 
 class DataboxTimeCharacteristic(Characteristic):
+    """
+    Box time and time sync.
+
+    Legacy: write a uint64 unix time in seconds, the clock is set if it is
+    more than TIME_THRESHOLD off. Reading returns the uint64 unix time.
+
+    Sync (all times int64 microseconds of unix time, little endian):
+      write SYNC_SAMPLE  uint8 seq, int64 t1 (phone clock when writing)
+                         [uint8 seq, int64 t4 of the previous sample]
+      read (once)        SYNC_SAMPLE, uint8 seq, int64 t2 (box clock when
+                         the write arrived), int64 t3 (box clock now);
+                         the phone notes t4 when the read returns
+      write SYNC_COMMIT  [uint8 seq, int64 t4 of the last sample]
+      read (once)        SYNC_COMMIT, uint8 SYNC_*, int64 offset, uint32 rtt
+    On commit the box takes the sample with the smallest round trip and
+    steps its clock by that sample's offset if it exceeds
+    SYNC_THRESHOLD_US. The RTC is written afterwards in a worker thread.
+    """
 
-    
     TIME_THRESHOLD = 120  # seconds (2 minutes)
-    
+
+    SYNC_SAMPLE = 0xA5
+    SYNC_COMMIT = 0xA7
+    SampleWrite = struct.Struct("<Bq")
+    SampleT4 = struct.Struct("<Bq")
+    SampleRead = struct.Struct("<BBqq")
+    CommitRead = struct.Struct("<BBqI")
+    # commit results
+    SYNC_APPLIED = 0
+    SYNC_IN_SYNC = 1
+    SYNC_NO_SAMPLES = 2
+    SYNC_FAILED = 3
+
+    SYNC_THRESHOLD_US = 5000
+    # samples kept until a commit, by seq
+    SYNC_MAX_SAMPLES = 16
+
     def __init__(self, bus, index, uuid, service):
         Characteristic.__init__(self, bus, index, uuid,
                                 ['read', 'write'], service)
+        # seq -> [t1, t2, t3, t4], t3/t4 None until known
+        self.samples = {}
+        self.last_seq = None
+        # answer to the next read after a sync write, None for the time
+        self.response = None
+        self._rtc_lock = threading.Lock()
+
+    @staticmethod
+    def now_us():
+        return time.time_ns() // 1000
 
     @dbus.service.method(GATT_CHRC_IFACE,
                          in_signature='a{sv}',
                          out_signature='ay')
-    
+
     def ReadValue(self, options):
+        if self.response is not None:
+            if self.response[0] == self.SYNC_SAMPLE and self.last_seq is not None:
+                sample = self.samples.get(self.last_seq)
+                if sample is not None and sample[2] is None:
+                    # t3 is taken as late as possible, right before replying
+                    sample[2] = self.now_us()
+                    self.response = self.SampleRead.pack(
+                        self.SYNC_SAMPLE, self.last_seq, sample[1], sample[2])
+            response = self.response
+            # answers one read, later reads return the time again
+            self.response = None
+            return dbus.ByteArray(response[int(options.get('offset', 0)):])
+
         now = int(time.time())
         print(f"[TimeCharacteristic] ReadValue → {now}")
 
@@ -30,35 +87,100 @@ class DataboxTimeCharacteristic(Characteristic):
 
     @dbus.service.method(GATT_CHRC_IFACE,in_signature='aya{sv}')
     def WriteValue(self, value, options):
-        incoming = struct.unpack("<Q", bytes(value))[0]
+        t2 = self.now_us()
+        value = bytes(value)
+        if len(value) == 8:
+            self.response = None
+            self.set_time_legacy(struct.unpack("<Q", value)[0])
+        elif value and value[0] == self.SYNC_SAMPLE:
+            self.add_sample(value[1:], t2)
+        elif value and value[0] == self.SYNC_COMMIT:
+            self.store_t4(value[1:])
+            self.commit()
+
+    def store_t4(self, payload):
+        """Complete a sample with the t4 the phone sent along."""
+        if len(payload) < self.SampleT4.size:
+            return
+        seq, t4 = self.SampleT4.unpack_from(payload)
+        sample = self.samples.get(seq)
+        if sample is not None and sample[2] is not None:
+            sample[3] = t4
+
+    def add_sample(self, payload, t2):
+        if len(payload) < self.SampleWrite.size:
+            return
+        seq, t1 = self.SampleWrite.unpack_from(payload)
+        self.store_t4(payload[self.SampleWrite.size:])
+        if len(self.samples) >= self.SYNC_MAX_SAMPLES and seq not in self.samples:
+            self.samples.pop(next(iter(self.samples)))
+        self.samples[seq] = [t1, t2, None, None]
+        self.last_seq = seq
+        self.response = bytes((self.SYNC_SAMPLE,))
+
+    def best_sample(self):
+        """(offset, rtt) in us of the complete sample with the smallest rtt."""
+        best = None
+        for t1, t2, t3, t4 in self.samples.values():
+            if t3 is None or t4 is None:
+                continue
+            rtt = (t4 - t1) - (t3 - t2)
+            if rtt < 0:
+                continue
+            offset = ((t2 - t1) + (t3 - t4)) // 2
+            if best is None or rtt < best[1]:
+                best = (offset, rtt)
+        return best
+
+    def commit(self):
+        best = self.best_sample()
+        self.samples.clear()
+        self.last_seq = None
+        if best is None:
+            result, offset, rtt = self.SYNC_NO_SAMPLES, 0, 0
+        else:
+            # offset is box - phone, the box clock has to move by -offset
+            offset, rtt = best
+            if abs(offset) <= self.SYNC_THRESHOLD_US:
+                result = self.SYNC_IN_SYNC
+            elif self.step_clock(-offset * 1000):
+                result = self.SYNC_APPLIED
+            else:
+                result = self.SYNC_FAILED
+            print(f"[Time] sync: offset {offset / 1000:.1f} ms, "
+                  f"rtt {rtt / 1000:.1f} ms, result {result}")
+        self.response = self.CommitRead.pack(
+            self.SYNC_COMMIT, result, offset, min(rtt, 0xFFFFFFFF))
+
+    def set_time_legacy(self, incoming):
         now = int(time.time())
         diff = incoming - now
-        
 
-        
         if abs(diff) <= self.TIME_THRESHOLD:
             print(f"[Time] Time not updated (|diff| <= {self.TIME_THRESHOLD}s).")
             return
-        
-        try:
-            # `date -s @<timestamp>`
-            subprocess.run(["sudo", "date", "-s", f"@{incoming}"], check=True)
-            print("System time updated.")
+
+        if self.step_clock(diff * 1_000_000_000):
             print(f"[Time] Old system time: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(now))}")
             print(f"[Time]   New timestamp: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(incoming))}")
 
-        except Exception as e:
-            print(f"Failed to set system time: {e}")
-            return
-
+    def step_clock(self, delta_ns):
+        """Move CLOCK_REALTIME by delta_ns in-process, then update the RTC."""
         try:
-            subprocess.run(
-                ["sudo", "hwclock", "--systohc"],
-                check=True
-            )
-            print("RTC updated from system time.")
-        except Exception as e:
-            print(f"Failed to update RTC: {e}")
-
-        return
+            time.clock_settime_ns(time.CLOCK_REALTIME, time.time_ns() + delta_ns)
+        except OSError as e:
+            print(f"Failed to set system time: {e}")
+            return False
+        print("System time updated.")
+        threading.Thread(target=self.update_rtc, daemon=True).start()
+        return True
 
+    def update_rtc(self):
+        # hwclock takes up to a second waiting for the RTC tick, keep it
+        # off the main loop; one writer at a time
+        with self._rtc_lock:
+            try:
+                subprocess.run(["hwclock", "--systohc"], check=True)
+                print("RTC updated from system time.")
+            except Exception as e:
+                print(f"Failed to update RTC: {e}")